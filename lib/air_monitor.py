@@ -0,0 +1,601 @@
+'''
+The board independent half of the monitor: the sensor, packet and
+networking classes, and the main loop body that ties them together.
+
+Nothing here imports board specific modules. code.py builds the real
+sensors, radio and sessions and hands them in, which lets the same
+classes run on CPython against simulated hardware (see
+tools/fleet_simulator.py).
+'''
+import time
+import json
+import gc
+import struct
+
+from memory_governor import MEMORY_SMALL_PACKETS, MEMORY_SUMMARY_ONLY, MEMORY_SPILL_BACKLOG, MEMORY_QUIET
+from link_supervisor import Link_Supervisor
+from uploaders import Uploader
+
+try:
+    from adafruit_requests import OutOfRetries
+except ImportError:
+    # Off the board nothing raises it, but the excepts below still
+    # need something to name
+    class OutOfRetries(Exception):
+        pass
+
+
+# Compact wire format header: magic, version, row count, key count
+_COMPACT_HEADER = '<2sBHB'
+_NAN = float('nan')
+
+
+class Sensor(object):
+    def __init__(self, name):
+        self.name = name
+        self.is_connected = False
+        self._in_keys = []
+        self.period = 0
+        self._last_read = None
+        # Whether the last update fell back to the null state
+        self.last_read_failed = False
+        pass
+
+    def set_input_keys(self, in_keys):
+        self._in_keys = in_keys
+    def set_period(self, period):
+        '''
+        Only read the sensor every period seconds, rather than
+        every pass of the sensor array
+        '''
+        self.period = period
+    def is_due(self, timestamp):
+        if self._last_read is not None and timestamp - self._last_read < self.period:
+            return False
+        self._last_read = timestamp
+        return True
+    def set_update(self, update_function):
+        '''
+        Attach a 'update reading' function to this class
+        making the call to update convient 
+        '''
+        self._run_update = update_function
+        return
+    def set_null_state(self, null_readings):
+        '''
+        Set default returns if a sensor is having trouble 
+        replying for update, formatted according to
+        how the update formats a return key, value pair
+        '''
+        self._null_reading_value = null_readings
+
+    def update(self, sensor, *args, **kwargs):
+        '''
+        Talks to the sensor and returns the sensor readings
+        in a key value paired dictionary naming which sensor
+        values were read
+        '''
+        #print("HIOINO", *args, **kwargs)
+        #print(self._in_keys)
+        try:
+            results = self._run_update(sensor, *args, **kwargs)
+            self.last_read_failed = False
+        except RuntimeError:
+            results = self._null_reading_value
+            self.last_read_failed = True
+        return results
+
+class Sensor_Array(object):
+    def __init__(self, list_of_sensors=[], clock=time.time):
+        self.list_of_sensors = list_of_sensors
+        self._clock = clock
+        # Most recent value of every key, for sensors that take
+        # another sensor's reading as input
+        self._latest = {}
+        # Keys holding a null state rather than a reading this pass
+        self.invalid_keys = []
+    def reading_keys(self):
+        '''
+        Every key the configured sensors can report, taken from their
+        null states. Connected or not, so the list (and a Sensor_Store
+        keyed on it) doesn't change with which sensors answer at boot
+        '''
+        keys = []
+        for sensor in self.list_of_sensors:
+            keys.extend(sensor._null_reading_value)
+        return keys
+    def update_sensors(self):
+        self.sensor_readings = {}
+        self.invalid_keys = []
+
+        timestamp = self._clock()
+        self.sensor_readings['raw_timestamp'] = timestamp
+        for sensor in self.list_of_sensors:
+            if sensor.is_connected:
+                if not sensor.is_due(timestamp):
+                    # Not read this pass, its keys go in empty so the
+                    # packet columns stay lined up
+                    for key in sensor._null_reading_value:
+                        self.sensor_readings[key] = None
+                    continue
+                #print("Updating new sensor, grabbing keys..")
+                #print(sensor.name)
+                key_args = {x:self._latest[x] for x in self._latest if x in sensor._in_keys}
+                #print('>',key_args)
+                if sensor._in_keys:
+                    sensor_values = sensor.update(sensor.sensor, key_args)
+                else:
+                    sensor_values = sensor.update(sensor.sensor)
+                self.sensor_readings.update(sensor_values)
+                self._latest.update(sensor_values)
+                if sensor.last_read_failed:
+                    self.invalid_keys.extend(sensor_values)
+        return self.sensor_readings
+
+class Sensors_Packet(object):
+    '''
+    Dictionary structure which the sensors dump their values into
+    Can be replace with dummy values without issue
+    
+    TODO:
+    - compress stable reading so longer bouts of stable values
+        results in fewer bytes needed 
+    '''
+    def __init__(self):
+        self.packet = {}
+        self.pack_size = 0
+    def update(self, sensor_readings):
+        for key in sensor_readings:
+            if key in self.packet:
+                self.packet[key].append(sensor_readings[key])
+            else:
+                self.packet[key] = [sensor_readings[key]]
+                
+        self.pack_size += 1
+    def print_and_update_raw(self, sensor_readings):
+        '''
+        Appends all of the input values to the packet dictionary then prints
+        out the latest values
+        '''
+        self.update(sensor_readings)
+        # Watch status and Memory Consumption as time goes on
+        spacer = '    '
+        vals = [str(x) for x in sensor_readings.values()]
+        print(spacer.join(vals))
+
+        return
+    def print_and_update_limited(self, sensor_readings):
+        '''
+        Appends all of the input values to the packet dictionary then prints
+        out the latest values
+        '''
+        self.update(sensor_readings)
+        # Watch status and Memory Consumption as time goes on
+        spacer = '    '
+        msg = str(sensor_readings['raw_timestamp'])+spacer+str(gc.mem_free())+spacer
+        if sensor_readings.get('temp_c') is not None:
+            msg += str(sensor_readings['temp_c']*9/5+32) + spacer
+        if 'humidity' in sensor_readings: 
+            msg += str(sensor_readings['humidity']) + spacer
+        if 'pressure' in sensor_readings:
+            msg += str(sensor_readings['pressure']) + spacer
+        if 'sgp40_raw' in sensor_readings:
+            msg += str(sensor_readings['sgp40_raw']) + spacer
+        if 'voc_index' in sensor_readings:
+            msg += str(sensor_readings['voc_index']) + spacer
+        if 'particles 03um' in sensor_readings:
+            msg += str(sensor_readings['particles 03um']) + spacer
+        if 'particles 05um' in sensor_readings:
+            msg += str(sensor_readings['particles 05um']) + spacer
+        if 'particles 10um' in sensor_readings:
+            msg += str(sensor_readings['particles 10um']) + spacer
+        if 'CO2' in sensor_readings:
+            msg += str(sensor_readings['CO2']) + spacer
+        if 'SCD4X_temp' in sensor_readings:
+            msg += str(sensor_readings['SCD4X_temp']) + spacer
+        if 'SCD4x_humidity' in sensor_readings:
+            msg += str(sensor_readings['SCD4x_humidity']) + spacer
+        #vals = [str(x) for x in sensor_readings.values()]
+        print(msg)
+
+        return
+    def time_range(self):
+        '''
+        First and last timestamp of the readings in the packet
+        '''
+        timestamps = self.packet['raw_timestamp']
+        return timestamps[0], timestamps[-1]
+    def prep_json(self):
+        '''
+        Converts and returns the sensor packet into json ready string
+        '''
+        return json.dumps(self.packet)
+    def prep_compact(self):
+        '''
+        Packs the sensor packet into the compact binary wire format:
+        a short header naming the keys, then the timestamps as uint32
+        and each key as a column of float32, all little endian.
+        Missing readings are NaN. Around 40% the size of the json for
+        a 20 reading packet from every sensor
+        '''
+        packet = self.packet
+        timestamps = packet['raw_timestamp']
+        count = len(timestamps)
+        keys = [key for key in packet if key != 'raw_timestamp']
+        parts = [struct.pack(_COMPACT_HEADER, b'AQ', 1, count, len(keys))]
+        for key in keys:
+            name = key.encode('utf-8')
+            parts.append(struct.pack('<B', len(name)) + name)
+        parts.append(struct.pack('<%dI' % count, *[int(t) for t in timestamps]))
+        for key in keys:
+            values = packet[key]
+            # A key first seen part way through belongs to the last readings
+            column = [_NAN] * (count - len(values))
+            column.extend(_NAN if value is None else value for value in values)
+            parts.append(struct.pack('<%df' % count, *column))
+        return b''.join(parts)
+
+class Summary_Packet(Sensors_Packet):
+    '''
+    Sensors_Packet for when ram is short: keeps a running min/max/mean
+    for each key instead of every reading, and posts as a single row in
+    the same shape Sensor_Store hands back its rollups
+    '''
+    def __init__(self):
+        self.pack_size = 0
+        self._first_timestamp = None
+        self._last_timestamp = None
+        self._mins = {}
+        self._maxs = {}
+        self._sums = {}
+        self._counts = {}
+    def update(self, sensor_readings):
+        for key in sensor_readings:
+            value = sensor_readings[key]
+            # A mean of bit masks means nothing, and the rollup already
+            # leaves out what was None
+            if key == 'raw_timestamp' or value is None or key.endswith('_mask'):
+                continue
+            if key in self._counts:
+                self._mins[key] = min(self._mins[key], value)
+                self._maxs[key] = max(self._maxs[key], value)
+                self._sums[key] += value
+                self._counts[key] += 1
+            else:
+                self._mins[key] = value
+                self._maxs[key] = value
+                self._sums[key] = value
+                self._counts[key] = 1
+        if self._first_timestamp is None:
+            self._first_timestamp = sensor_readings['raw_timestamp']
+        self._last_timestamp = sensor_readings['raw_timestamp']
+
+        self.pack_size += 1
+    @property
+    def packet(self):
+        packet = {'raw_timestamp': [self._first_timestamp],
+                  'rollup_seconds': [self._last_timestamp - self._first_timestamp + 1],
+                  'samples': [self.pack_size]}
+        for key in self._counts:
+            packet[key] = [self._sums[key] / self._counts[key]]
+            packet[key + '_min'] = [self._mins[key]]
+            packet[key + '_max'] = [self._maxs[key]]
+        return packet
+    def time_range(self):
+        return self._first_timestamp, self._last_timestamp
+
+
+class Current_Web_Status(Uploader):
+    '''
+    Handles all 'connect to internet' type communications.
+
+    Wraps everything in nice try and excepts to handle being
+    outside of the wifi's range, and to handle events where
+    the home server is down. Prioritizes reliable sensor recordings
+    over internet connection
+
+    Base Functionality:
+        Networking:
+            connect_with_mywifi
+            start_sessions_pool
+            _get_request_socket
+            _close_request_socket
+
+        Sensor Data Management:
+            get_sea_level
+            post_sensor_packet
+
+
+    The radio, socket pool and request session are handed in rather
+    than imported, so code.py passes wifi.radio, socketpool.SocketPool
+    and an adafruit_requests.Session maker, and a simulation can pass
+    stand-ins. status_pixel is the neopixel used to show post failures.
+    wire_format picks how packets are posted: "json" or "compact".
+
+    Whether the wifi is worth using is left to a Link_Supervisor, which
+    is built from the radio and credentials unless one is passed in, so
+    a dead link is skipped rather than reconnected on every request.
+
+    This is the HTTP one of the uploaders in uploaders.py: the backlog,
+    retries and link handling for post_sensor_packet come from Uploader.
+
+    TODO:
+    - Create a packet buffer for when transmittion is not possible,
+        and ensure buffer does not exceed limited ram
+    '''
+    def __init__(self, radio, pool_factory, session_factory,
+                 base_url="http://192.168.1.147:5000/", credentials=None, status_pixel=None,
+                 link=None, wire_format="json"):
+        self.radio = radio
+        if link is None:
+            link = Link_Supervisor(radio, credentials)
+        super().__init__(link, status_pixel, wire_format)
+        self._pool_factory = pool_factory
+        self._session_factory = session_factory
+        self._base_url = base_url
+        self.connection_pool_available = False
+        self._used_sockets = 0
+        self._total_sockets_requested = 0
+        self._attempted_requests = 0
+        self._successful_requests = 0
+        self._socket_issues = 0
+    @property
+    def connected_to_network(self):
+        return self.link.is_up
+    def connect_with_mywifi(self):
+        '''
+        Connect now, without waiting on the link backoff. Returns
+        whether it worked rather than raising
+        '''
+        return self.link.connect()
+    def start_sessions_pool(self):
+        self.socket = self._pool_factory(self.radio)
+        self.connection_pool_available = True
+        self._get_request_socket()
+        pass
+    def _get_request_socket(self):
+        self.https = self._session_factory(self.socket)
+
+    def _close_request_socket(self, response):
+        # Hopefully this works
+        response.close()
+        self._used_sockets -= 1
+        print("active sockets", self._used_sockets)
+        return 
+
+    def get_sea_level(self):
+        '''
+        Go to the home server to try and grab json of weather values to 
+        get pressure at sea level after checking if we're connected
+        to the wifi
+
+        '''
+
+        sea_level_pressure = None
+
+        # Before doing anything, double check the link is usable.
+        # The supervisor reconnects if it's down and the backoff allows
+
+        # Go to server
+        if self.link.ready():
+            # Open Socket
+            site_weather_vals = self._base_url + "api/weather_status"
+            print("Fetching and parsing json from", site_weather_vals)
+
+
+            # Get Json
+            while True:
+                try:
+                    response = self.https.get(site_weather_vals) 
+                    text = response.text
+                    self.homeserver_is_online = True
+                    self.link.report_success()
+                    sea_level_pressure = json.loads(text)["sea level"]
+
+
+
+                    # Close Socket
+                    try: 
+                        self._close_request_socket(response)
+                    except Exception as e:
+                        print(e)
+                        raise(e)
+                    break
+                except OutOfRetries:
+                    print("OUT OF RETRIES CAUGHT")
+                    pass
+                except Exception as e:
+                    self.homeserver_is_online = False
+                    print("CAN'T CONNECT TO HOME SERVER")
+                    #raise(e)
+                break
+
+        return sea_level_pressure
+
+
+    def _send(self, sensor_packet):
+        '''
+        Convert a packet of data to json (or the compact format), then
+        post it to the home server.
+        '''
+        post_sensor_webpage = self._base_url + "enviornmental_sensors"
+        try:
+            if self.wire_format == "compact":
+                response = self.https.post(post_sensor_webpage, data=self.payload(sensor_packet),
+                                           headers={"Content-Type": "application/octet-stream"})
+            else:
+                response = self.https.post(post_sensor_webpage, json=self.payload(sensor_packet))
+        except OutOfRetries as e:
+            print(">Outofretries>", e)
+            raise RuntimeError("Out of retries")
+        self.homeserver_is_online = True
+        try: 
+            self._close_request_socket(response)
+        except Exception as e:
+            print("During closing of socket, error occured", e)
+
+
+def set_bme280_sea_level_pressure(bme280, my_network):
+    # Grab up to date pressure at sealevel
+    sea_level = my_network.get_sea_level()
+    if my_network.homeserver_is_online:
+        bme280.sea_level_pressure = sea_level
+    return bme280
+
+
+class Air_Quality_Monitor(object):
+    '''
+    The main loop body: reads the sensors into a Sensors_Packet, queues
+    full packets for the home server, and keeps the queue within ram
+    by dropping the oldest packet. Dropped time ranges are backfilled
+    from the Sensor_Store, when there is one, once the queue is empty.
+
+    network is whichever uploader the packets leave by (Current_Web_Status
+    for HTTP, or one from uploaders.py); the queue works the same for all.
+
+    With a Reading_Filter, each reading goes through it before it reaches
+    the packet or the store, so null states and outliers go out as None.
+
+    With a Memory_Governor it also samples free memory every tick and
+    cuts back packet sizes, packet detail, backlog and console output at
+    the level the governor calls for.
+
+    Keeps counts of what it has had to drop so the fleet simulator can
+    report data loss.
+    '''
+    def __init__(self, sensor_array, network, sensor_store=None,
+                 packet_size_limit=20, backlog_limit=10, verbose=True,
+                 memory_governor=None, reading_filter=None):
+        self.sensor_array = sensor_array
+        self.network = network
+        self.sensor_store = sensor_store
+        self.packet_size_limit = packet_size_limit
+        self.backlog_limit = backlog_limit
+        self.verbose = verbose
+        self.memory_governor = memory_governor
+        self.reading_filter = reading_filter
+
+        # What the current memory level allows
+        self._packet_limit = packet_size_limit
+        self._summary_only = False
+        self._quiet = False
+
+        self.sensor_pack = Sensors_Packet()
+        self.packets_to_post = []
+        self.backfill_ranges = []
+        self.dropped_packets = 0
+        self.dropped_readings = 0
+
+    def _new_packet(self):
+        if self._summary_only:
+            return Summary_Packet()
+        return Sensors_Packet()
+
+    def _apply_memory_level(self, level):
+        self._summary_only = level >= MEMORY_SUMMARY_ONLY
+        if level >= MEMORY_SMALL_PACKETS and not self._summary_only:
+            self._packet_limit = max(1, self.packet_size_limit // 4)
+        else:
+            # A summary packet is one row however many readings it covers,
+            # so cutting it short would only mean more posts
+            self._packet_limit = self.packet_size_limit
+        if level >= MEMORY_SPILL_BACKLOG:
+            # Keep only the packet being retried, the store has the rest
+            while len(self.packets_to_post) > 1:
+                self._drop_packet(1)
+        self._quiet = level >= MEMORY_QUIET
+
+    def tick(self):
+        if self.memory_governor is not None:
+            self._apply_memory_level(self.memory_governor.sample())
+
+        # Read sensors
+        sensor_readings = self.sensor_array.update_sensors()
+        if self.reading_filter is not None:
+            sensor_readings = self.reading_filter.apply(sensor_readings, self.sensor_array.invalid_keys)
+        if self.verbose and not self._quiet:
+            self.sensor_pack.print_and_update_limited(sensor_readings)
+        else:
+            self.sensor_pack.update(sensor_readings)
+        if self.sensor_store is not None:
+            try:
+                self.sensor_store.append(sensor_readings)
+            except OSError as e:
+                self._disable_store(e)
+
+        # Sensor pack is at size, add it to the the list of packs to post
+        # and generate a new one
+        if self.sensor_pack.pack_size >= self._packet_limit:
+            self.packets_to_post.append(self.sensor_pack)
+            self.sensor_pack = self._new_packet()
+        # there's a pack to post, let's post it
+        send_attempts = self.network.send_attempts
+        if len(self.packets_to_post) > 0:
+            success = self.network.post_sensor_packet(self.packets_to_post[0])
+            if success:
+                self.packets_to_post = self.packets_to_post[1:]
+        # nothing waiting, so fill in any readings we had to drop earlier
+        elif self.backfill_ranges:
+            self._backfill()
+        # the post has let go of its json and response, a good time to
+        # collect. Not when the uploader skipped it, during an outage that
+        # would be a collection every tick
+        if self.network.send_attempts != send_attempts and self.memory_governor is not None:
+            self.memory_governor.after_post()
+        # there's too many packs, let's just drop one for ram
+        if len(self.packets_to_post) > self.backlog_limit:
+            self._drop_packet(0)
+        return sensor_readings
+
+    def _backfill(self):
+        gap_start, gap_end = self.backfill_ranges[0]
+        backfill_pack = Sensors_Packet()
+        last_reading = None
+        try:
+            for reading in self.sensor_store.read_range(gap_start, gap_end, limit=self._packet_limit):
+                # One tier per packet: a packet lines a key that turns up
+                # part way through with its last rows, so rollup keys
+                # followed by raw rows would land on the wrong ones
+                if last_reading is not None and \
+                        reading.get('rollup_seconds') != last_reading.get('rollup_seconds'):
+                    break
+                backfill_pack.update(reading)
+                last_reading = reading
+        except OSError as e:
+            self._disable_store(e)
+            return
+        if backfill_pack.pack_size == 0:
+            # Aged out of the store, nothing left to send
+            self.backfill_ranges.pop(0)
+        elif self.network.post_sensor_packet(backfill_pack):
+            # A rollup covers its whole bucket, so carry on after the
+            # bucket rather than its start, or the same one comes back
+            resume = last_reading['raw_timestamp'] + last_reading.get('rollup_seconds', 1)
+            if resume > gap_end:
+                self.backfill_ranges.pop(0)
+            else:
+                self.backfill_ranges[0] = (resume, gap_end)
+
+    def _disable_store(self, error):
+        # Flash full or gone bad, carry on without the history rather
+        # than stopping the readings with it
+        print("History store disabled", error)
+        store = self.sensor_store
+        self.sensor_store = None
+        self.backfill_ranges = []
+        try:
+            store.close()
+        except OSError:
+            pass
+
+    def _drop_packet(self, index):
+        dropped_pack = self.packets_to_post.pop(index)
+        self.dropped_packets += 1
+        self.dropped_readings += dropped_pack.pack_size
+        if self.sensor_store is not None:
+            # remember the gap so it can be backfilled from the store
+            first, last = dropped_pack.time_range()
+            if self.backfill_ranges and 0 <= first - self.backfill_ranges[-1][1] <= 5:
+                self.backfill_ranges[-1] = (self.backfill_ranges[-1][0], last)
+            else:
+                self.backfill_ranges.append((first, last))
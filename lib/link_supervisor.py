@@ -0,0 +1,276 @@
+'''
+Wi-Fi link supervisor
+
+Keeps track of whether the wifi link is usable, so the rest of the
+monitor can check before an upload instead of finding out by blocking
+on a request or a reconnect every tick.
+
+States:
+    LINK_DOWN       not associated, reconnects once the backoff allows
+    LINK_UP         associated and the home server last answered
+    LINK_SUSPECT    a request failed, the link is checked before it is
+                    used again
+
+Credentials are read from secrets.py once. After a successful connect
+the access point's BSSID and channel are cached, so reconnecting can
+skip the scan and go straight to that access point; if that fails it
+falls back to a full connect. Failed attempts back off exponentially,
+with jitter so a fleet of monitors doesn't come back in step.
+
+Before an upload, ready() checks the association (radio.ap_info) and
+signal strength, and pings the server if the link is suspect or hasn't
+been confirmed for probe_interval seconds. Nothing is retried sooner than
+the backoff allows, so a dead link costs a few attribute reads a tick.
+
+A ping is only a hint. Plenty of servers never answer one (a Windows
+firewall by default), so once the backoff is up the upload goes ahead
+anyway and its own success or failure settles the link. If
+max_failed_pings pings fail with no upload getting through in between,
+the association is started over with a fresh connect.
+
+Simulated_Radio stands in for wifi.radio on CPython, and can drop and
+restore the network.
+'''
+import time
+import random
+
+
+LINK_DOWN = 0
+LINK_UP = 1
+LINK_SUSPECT = 2
+
+LINK_NAMES = ("down", "up", "suspect")
+
+
+class Link_Supervisor(object):
+    '''
+    Link state machine around wifi.radio.
+
+    ping_address is the address to probe (an ipaddress.ip_address on
+    the board), or None to judge the link on the association alone.
+    clock is in seconds and defaults to time.monotonic. rng supplies the
+    backoff jitter, anything with a random() method, so a simulation can
+    pass a seeded random.Random.
+    '''
+    def __init__(self, radio, credentials=None, ping_address=None, clock=time.monotonic,
+                 probe_interval=60, weak_rssi=-80, min_backoff=1, max_backoff=64, rng=random,
+                 max_failed_pings=3):
+        self.radio = radio
+        self._credentials = credentials
+        self.ping_address = ping_address
+        self._clock = clock
+        self._rng = rng
+        self.probe_interval = probe_interval
+        self.weak_rssi = weak_rssi
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_failed_pings = max_failed_pings
+
+        self.state = LINK_DOWN
+        self.state_changed_at = clock()
+        self._listeners = []
+        self._cached_bssid = None
+        self._cached_channel = 0
+        self._backoff = 0
+        self._next_attempt = 0
+        self._last_ok = None
+        self._failed_pings = 0
+
+        self.connect_attempts = 0
+        self.fast_connects = 0
+        self.pings = 0
+
+    @property
+    def is_up(self):
+        return self.state == LINK_UP
+
+    def add_listener(self, callback):
+        '''
+        callback(state) is called whenever the link state changes
+        '''
+        self._listeners.append(callback)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        self.state_changed_at = self._clock()
+        print("Wifi link", LINK_NAMES[state])
+        for callback in self._listeners:
+            callback(state)
+
+    def _load_credentials(self):
+        if self._credentials is None:
+            try:
+                from secrets import secrets
+            except ImportError:
+                print("WiFi secrets are kept in secrets.py, please add them there!")
+                raise
+            self._credentials = secrets
+        return self._credentials
+
+    def _mark_ok(self):
+        self._failed_pings = 0
+        self._backoff = 0
+        self._next_attempt = 0
+        self._last_ok = self._clock()
+        self._set_state(LINK_UP)
+
+    def _back_off(self):
+        if self._backoff:
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+        else:
+            self._backoff = self.min_backoff
+        # Up to half again, so monitors that lost the link together spread out
+        self._next_attempt = self._clock() + self._backoff * (1 + self._rng.random() / 2)
+
+    def connect(self):
+        '''
+        Associate with the access point, trying the cached one first.
+        Never raises for a network that isn't there; returns whether
+        the link is up
+        '''
+        credentials = self._load_credentials()
+        self.connect_attempts += 1
+        connected = False
+        if self._cached_bssid is not None:
+            try:
+                self.radio.connect(credentials["ssid"], credentials["password"],
+                                   channel=self._cached_channel, bssid=self._cached_bssid)
+                connected = True
+                self.fast_connects += 1
+            except Exception:
+                # Access point moved or isn't up yet, try a full connect.
+                # The cache is only replaced once one works
+                pass
+        if not connected:
+            try:
+                self.radio.connect(credentials["ssid"], credentials["password"])
+                connected = True
+            except Exception as e:
+                print("CAN'T CONNECT TO NEWTORK", e)
+
+        if connected:
+            ap_info = self.radio.ap_info
+            if ap_info is not None:
+                self._cached_bssid = bytes(ap_info.bssid)
+                self._cached_channel = ap_info.channel
+            self._mark_ok()
+        else:
+            self._set_state(LINK_DOWN)
+            self._back_off()
+        return connected
+
+    def _ping(self):
+        if self.ping_address is None:
+            return True
+        self.pings += 1
+        try:
+            return self.radio.ping(self.ping_address) is not None
+        except Exception:
+            return False
+
+    def ready(self):
+        '''
+        Call before an upload: returns whether it is worth trying one.
+        Reconnects or probes only when the backoff allows
+        '''
+        now = self._clock()
+        if now < self._next_attempt:
+            return self.state == LINK_UP
+        if self.state == LINK_DOWN:
+            return self.connect()
+
+        ap_info = self.radio.ap_info
+        if ap_info is None:
+            # Association is gone, no point pinging
+            self._set_state(LINK_DOWN)
+            return self.connect()
+
+        stale = self._last_ok is None or now - self._last_ok >= self.probe_interval
+        if self.state == LINK_SUSPECT or stale or ap_info.rssi < self.weak_rssi:
+            if self._ping():
+                self._mark_ok()
+                return True
+            self._failed_pings += 1
+            if self._failed_pings >= self.max_failed_pings:
+                # Pings and uploads both failing, start the association over.
+                # A fresh association doesn't prove the server is there, so
+                # the backoff carries on growing rather than starting again
+                backoff = self._backoff
+                self._set_state(LINK_DOWN)
+                if self.connect():
+                    self._backoff = backoff
+                    self._back_off()
+                    return True
+                return False
+            self._set_state(LINK_SUSPECT)
+            self._back_off()
+            # The server may just not answer pings, the upload is the real test
+            return True
+        return self.state == LINK_UP
+
+    def report_success(self):
+        '''
+        A request to the server went through
+        '''
+        self._mark_ok()
+
+    def report_failure(self):
+        '''
+        A request failed at the network level (OSError): check the link
+        before the next upload rather than reconnecting straight away
+        '''
+        if self.state == LINK_UP:
+            self._set_state(LINK_SUSPECT)
+
+
+class _Simulated_AP_Info(object):
+    def __init__(self, bssid, channel, rssi):
+        self.bssid = bssid
+        self.channel = channel
+        self.rssi = rssi
+
+
+class Simulated_Radio(object):
+    '''
+    Stands in for wifi.radio on CPython. drop() takes the network away
+    (and the current association with it), restore() brings it back.
+    Counts connects and pings so tests can see what the supervisor did.
+    '''
+    def __init__(self, bssid=b'\x02\x00\x00\x00\x00\x01', channel=6, rssi=-55, ping_time=0.005):
+        self.bssid = bssid
+        self.channel = channel
+        self.rssi = rssi
+        self.ping_time = ping_time
+        self.network_available = True
+        self.connected = False
+        self.connect_calls = 0
+        self.ping_calls = 0
+
+    def drop(self):
+        self.network_available = False
+        self.connected = False
+
+    def restore(self):
+        self.network_available = True
+
+    def connect(self, ssid, password=b'', channel=0, bssid=None):
+        self.connect_calls += 1
+        if not self.network_available:
+            raise ConnectionError("No network with that ssid")
+        if bssid is not None and bytes(bssid) != self.bssid:
+            raise ConnectionError("No network with that ssid")
+        self.connected = True
+
+    @property
+    def ap_info(self):
+        if not self.connected:
+            return None
+        return _Simulated_AP_Info(self.bssid, self.channel, self.rssi)
+
+    def ping(self, address, timeout=0.5):
+        self.ping_calls += 1
+        if not self.connected:
+            return None
+        return self.ping_time
@@ -0,0 +1,132 @@
+'''
+Memory pressure governor
+
+Samples the free heap once per tick and steps the monitor through
+degradation levels as it runs low, rather than letting a long outage
+end in a MemoryError part way through prep_json or a post:
+
+    MEMORY_NORMAL           everything as configured
+    MEMORY_SMALL_PACKETS    packets are cut to a quarter of packet_size_limit
+    MEMORY_SUMMARY_ONLY     new packets keep min/max/mean, not every reading,
+                            back at the full packet_size_limit
+    MEMORY_SPILL_BACKLOG    the backlog is dropped down to the packet being
+                            retried, leaving the rest to the Sensor_Store
+    MEMORY_QUIET            no console output
+
+Levels only step back down once free memory is back above the threshold
+with some room to spare, so the monitor doesn't flap between them.
+
+gc.collect() is run at quiet points (the start of a tick when memory is
+short, and right after a post has let go of its json and response)
+instead of leaving it to trigger mid serialization.
+
+Off the board gc has no mem_free, so pass a Simulated_Heap's mem_free and
+collect to run the governor under CPython.
+'''
+import gc
+
+
+MEMORY_NORMAL = 0
+MEMORY_SMALL_PACKETS = 1
+MEMORY_SUMMARY_ONLY = 2
+MEMORY_SPILL_BACKLOG = 3
+MEMORY_QUIET = 4
+
+LEVEL_NAMES = ("normal", "small packets", "summary only", "spill backlog", "quiet")
+
+
+class Memory_Governor(object):
+    '''
+    Tracks free heap and the degradation level it calls for.
+
+    thresholds are the free byte counts below which each level past
+    MEMORY_NORMAL starts, highest first. Keeps the lowest free memory seen
+    (the high-water mark of heap use) and the highest level reached.
+    '''
+    def __init__(self, mem_free=None, collect=None,
+                 thresholds=(65536, 49152, 32768, 16384), hysteresis=8192):
+        if mem_free is None:
+            mem_free = gc.mem_free
+        if collect is None:
+            collect = gc.collect
+        self._mem_free = mem_free
+        self._collect = collect
+        self.thresholds = thresholds
+        self.hysteresis = hysteresis
+
+        self.level = MEMORY_NORMAL
+        self.free = None
+        self.lowest_free = None
+        self.highest_level = MEMORY_NORMAL
+        self.collections = 0
+
+    def collect(self):
+        self._collect()
+        self.collections += 1
+        self.free = self._mem_free()
+        return self.free
+
+    def sample(self):
+        '''
+        Check free memory, collecting first if it looks short, and
+        return the level the monitor should run at this tick
+        '''
+        free = self._mem_free()
+        if free < self.thresholds[0]:
+            # Only act on memory that is really in use
+            free = self.collect()
+        self.free = free
+        if self.lowest_free is None or free < self.lowest_free:
+            self.lowest_free = free
+
+        level = MEMORY_NORMAL
+        for threshold in self.thresholds:
+            if free < threshold:
+                level += 1
+
+        previous = self.level
+        if level > self.level:
+            self.level = level
+        else:
+            while self.level > level and free >= self.thresholds[self.level - 1] + self.hysteresis:
+                self.level -= 1
+        if self.level != previous:
+            print("Memory", free, "free, running at level:", LEVEL_NAMES[self.level])
+        self.highest_level = max(self.highest_level, self.level)
+        return self.level
+
+    def after_post(self):
+        '''
+        A post has just finished with its json string and response,
+        which is the cheapest time to collect
+        '''
+        return self.collect()
+
+
+class Simulated_Heap(object):
+    '''
+    A heap budget for exercising the governor on CPython. Released
+    memory stays used until collect(), as it does on the board.
+    '''
+    def __init__(self, budget, used=0):
+        self.budget = budget
+        self.used = used
+        self.garbage = 0
+
+    def allocate(self, size):
+        if self.used + self.garbage + size > self.budget:
+            # The board collects once before giving up
+            self.collect()
+        if self.used + size > self.budget:
+            raise MemoryError("memory allocation failed, allocating %d bytes" % size)
+        self.used += size
+
+    def release(self, size):
+        self.used -= size
+        self.garbage += size
+
+    def mem_free(self):
+        return self.budget - self.used - self.garbage
+
+    def collect(self):
+        self.garbage = 0
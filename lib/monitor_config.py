@@ -0,0 +1,322 @@
+'''
+Monitor configuration
+
+Everything that used to be a literal in code.py (server endpoints, how
+packets are uploaded, packet sizing, the backlog cap, the loop period,
+which sensors to use, how often to read them, their null states and how
+to filter them) comes from one json file, /config.json on the board,
+loaded once at boot. json is parsed in C on CircuitPython, so loading it
+is cheap next to the sensor setup.
+
+Keys left out of the file take their value from DEFAULT_CONFIG, so a
+config only needs what differs from the defaults. Runs unchanged under
+CPython, which is how tools/validate_config.py checks a file before it
+goes on a board.
+'''
+import json
+
+
+WIRE_FORMATS = ("json", "compact")
+UPLOADER_BACKENDS = ("http", "mqtt", "file")
+
+DEFAULT_CONFIG = {
+    "server": {
+        "base_url": "http://192.168.1.147:5000/",
+        # Pinged to check the wifi link, null to skip the ping
+        "ping_address": "192.168.1.147",
+    },
+    "period": 1,
+    "packet_size_limit": 20,
+    "backlog_limit": 10,
+    "wire_format": "json",
+    # How packets leave the board, see lib/uploaders.py. "http" posts to
+    # server.base_url, "mqtt" publishes to a broker, "file" writes them to
+    # flash, or to the usb serial data channel when file.path is null
+    "uploader": {
+        "backend": "http",
+        "mqtt": {
+            "broker": "192.168.1.147",
+            "port": 1883,
+            # null uses the board's mac address
+            "client_id": None,
+            # Packets go to <topic_prefix>/<client_id>/packets
+            "topic_prefix": "air_monitor",
+            "keep_alive": 60,
+        },
+        "file": {
+            "path": "/packets.log",
+            "max_bytes": 262144,
+        },
+    },
+    "history": {
+        "enabled": True,
+        "directory": "/history",
+        "block_size": 4096,
+        "raw_retention": 3600,
+        "minute_retention": 86400,
+        "quarter_retention": 1209600,
+    },
+    "memory": {
+        "thresholds": [65536, 49152, 32768, 16384],
+        "hysteresis": 8192,
+    },
+    "profiling": {
+        "enabled": False,
+        # Recent spans kept between dumps
+        "capacity": 256,
+        "dump_every": 60,
+        # null dumps to the serial console
+        "dump_path": None,
+    },
+    # Outlier and sensor fault filtering, see lib/reading_filter.py.
+    # Each sensor below can also set:
+    #   warmup      seconds after its first reading to flag as warming up
+    #   max_rate    per key, the fastest it can really change per second
+    #   median      report the median of the window instead of the raw value
+    "filter": {
+        "enabled": True,
+        "median_window": 3,
+    },
+    "sensors": {
+        "bme280": {
+            "enabled": True,
+            "period": 1,
+            # Used until the home server supplies one
+            "sea_level_pressure": 1001.7,
+            "null_state": {"temp_c": -40, "humidity": -1, "pressure": -1},
+            "warmup": 2,
+            # Faster than this is an I2C glitch, not the room
+            "max_rate": {"temp_c": 2, "humidity": 10, "pressure": 5},
+            "median": False,
+        },
+        "sgp40": {
+            "enabled": True,
+            "period": 1,
+            "null_state": {"sgp40_raw": -1, "voc_index": -1},
+            # The VOC index algorithm needs its first minute to settle
+            "warmup": 60,
+            "max_rate": {},
+            "median": False,
+        },
+        "PM2.5": {
+            "enabled": True,
+            "period": 1,
+            "null_state": {"particles 03um": -1, "particles 05um": -1,
+                           "particles 100um": -1, "particles 10um": -1,
+                           "particles 25um": -1, "particles 50um": -1,
+                           "pm10 env": -1, "pm10 standard": -1,
+                           "pm100 env": -1, "pm100 standard": -1,
+                           "pm25 env": -1, "pm25 standard": -1},
+            # Fan spin up
+            "warmup": 30,
+            "max_rate": {},
+            "median": True,
+        },
+        "SCD4x": {
+            "enabled": True,
+            "period": 1,
+            "null_state": {"CO2": -1, "SCD4X_temp": -40, "SCD4x_humidity": -1},
+            # First few periodic measurements read high
+            "warmup": 30,
+            "max_rate": {"CO2": 200},
+            "median": False,
+        },
+    },
+}
+
+
+def merge_config(defaults, overrides):
+    '''
+    Lay overrides over defaults, one nested object at a time
+    '''
+    merged = {}
+    for key in defaults:
+        merged[key] = defaults[key]
+    for key in overrides:
+        if key in defaults and isinstance(defaults[key], dict) and isinstance(overrides[key], dict):
+            merged[key] = merge_config(defaults[key], overrides[key])
+        else:
+            merged[key] = overrides[key]
+    return merged
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _check_positive(errors, name, value, integer=True):
+    kind = int if integer else (int, float)
+    if not isinstance(value, kind) or isinstance(value, bool) or value <= 0:
+        errors.append("%s must be a positive %s, got %r"
+                      % (name, "integer" if integer else "number", value))
+
+
+# Maps whose keys are the sensors' reading keys rather than settings
+_FREE_FORM = ("null_state", "max_rate")
+
+
+def _check_unknown(errors, defaults, config, prefix):
+    '''
+    Every key has to be one DEFAULT_CONFIG has at the same place, so a
+    misspelling is reported rather than quietly running on the default.
+    Sensors are included: code.py only builds the ones named there
+    '''
+    for key in config:
+        name = prefix + key
+        if key not in defaults:
+            if prefix == "sensors.":
+                errors.append("unknown sensor %r, expected one of %s"
+                              % (key, ", ".join(sorted(defaults))))
+            else:
+                errors.append("unknown setting %r" % name)
+        elif (key not in _FREE_FORM and isinstance(defaults[key], dict)
+              and isinstance(config[key], dict)):
+            _check_unknown(errors, defaults[key], config[key], name + ".")
+
+
+def validate_config(config):
+    '''
+    Returns a list of everything wrong with a merged config, empty if
+    it is good to run
+    '''
+    errors = []
+    _check_unknown(errors, DEFAULT_CONFIG, config, "")
+    # A section that isn't an object is reported and its defaults are
+    # checked in its place, so every other section still gets checked
+    config = dict(config)
+    for key in ("server", "uploader", "history", "memory", "profiling", "filter", "sensors"):
+        if not isinstance(config[key], dict):
+            errors.append("%s must be an object" % key)
+            config[key] = DEFAULT_CONFIG[key]
+    config["uploader"] = dict(config["uploader"])
+    for key in ("mqtt", "file"):
+        if not isinstance(config["uploader"].get(key), dict):
+            errors.append("uploader.%s must be an object" % key)
+            config["uploader"][key] = DEFAULT_CONFIG["uploader"][key]
+
+    server = config["server"]
+    base_url = server.get("base_url")
+    if not isinstance(base_url, str) or not base_url.startswith("http://") or not base_url.endswith("/"):
+        errors.append("server.base_url must be an http:// url ending in /, got %r" % (base_url,))
+    ping_address = server.get("ping_address")
+    if ping_address is not None:
+        parts = ping_address.split(".") if isinstance(ping_address, str) else []
+        if len(parts) != 4 or not all(part.isdigit() and int(part) < 256 for part in parts):
+            errors.append("server.ping_address must be an IPv4 address or null, got %r" % (ping_address,))
+
+    _check_positive(errors, "period", config["period"], integer=False)
+    _check_positive(errors, "packet_size_limit", config["packet_size_limit"])
+    _check_positive(errors, "backlog_limit", config["backlog_limit"])
+    if config["wire_format"] not in WIRE_FORMATS:
+        errors.append("wire_format must be one of %s, got %r"
+                      % (", ".join(WIRE_FORMATS), config["wire_format"]))
+
+    uploader = config["uploader"]
+    if uploader["backend"] not in UPLOADER_BACKENDS:
+        errors.append("uploader.backend must be one of %s, got %r"
+                      % (", ".join(UPLOADER_BACKENDS), uploader["backend"]))
+    mqtt = uploader["mqtt"]
+    if not isinstance(mqtt["broker"], str) or not mqtt["broker"]:
+        errors.append("uploader.mqtt.broker must be a host name or address, got %r" % (mqtt["broker"],))
+    port = mqtt["port"]
+    if not isinstance(port, int) or isinstance(port, bool) or not 0 < port < 65536:
+        errors.append("uploader.mqtt.port must be a port number, got %r" % (port,))
+    client_id = mqtt["client_id"]
+    if client_id is not None and (not isinstance(client_id, str) or not client_id):
+        errors.append("uploader.mqtt.client_id must be a string or null, got %r" % (client_id,))
+    topic_prefix = mqtt["topic_prefix"]
+    if not isinstance(topic_prefix, str) or not topic_prefix or "+" in topic_prefix or "#" in topic_prefix:
+        errors.append("uploader.mqtt.topic_prefix must be a topic without wildcards, got %r" % (topic_prefix,))
+    _check_positive(errors, "uploader.mqtt.keep_alive", mqtt["keep_alive"])
+    file_sink = uploader["file"]
+    path = file_sink["path"]
+    if path is not None and (not isinstance(path, str) or not path.startswith("/")):
+        errors.append("uploader.file.path must be an absolute path or null, got %r" % (path,))
+    if file_sink["max_bytes"] is not None:
+        _check_positive(errors, "uploader.file.max_bytes", file_sink["max_bytes"])
+
+    history = config["history"]
+    if not isinstance(history["enabled"], bool):
+        errors.append("history.enabled must be true or false")
+    if not isinstance(history["directory"], str) or not history["directory"].startswith("/"):
+        errors.append("history.directory must be an absolute path, got %r" % (history["directory"],))
+    for key in ("block_size", "raw_retention", "minute_retention", "quarter_retention"):
+        _check_positive(errors, "history." + key, history[key])
+
+    memory = config["memory"]
+    thresholds = memory["thresholds"]
+    if (not isinstance(thresholds, list) or len(thresholds) != 4
+            or not all(isinstance(t, int) and t > 0 for t in thresholds)
+            or sorted(thresholds, reverse=True) != thresholds):
+        errors.append("memory.thresholds must be four positive integers, highest first")
+    _check_positive(errors, "memory.hysteresis", memory["hysteresis"])
+
+    profiling = config["profiling"]
+    if not isinstance(profiling["enabled"], bool):
+        errors.append("profiling.enabled must be true or false")
+    _check_positive(errors, "profiling.capacity", profiling["capacity"])
+    _check_positive(errors, "profiling.dump_every", profiling["dump_every"])
+    dump_path = profiling["dump_path"]
+    if dump_path is not None and (not isinstance(dump_path, str) or not dump_path.startswith("/")):
+        errors.append("profiling.dump_path must be an absolute path or null, got %r" % (dump_path,))
+
+    reading_filter = config["filter"]
+    if not isinstance(reading_filter["enabled"], bool):
+        errors.append("filter.enabled must be true or false")
+    median_window = reading_filter["median_window"]
+    if not isinstance(median_window, int) or isinstance(median_window, bool) or median_window < 1 or median_window % 2 == 0:
+        errors.append("filter.median_window must be a positive odd integer, got %r" % (median_window,))
+
+    for name in config["sensors"]:
+        sensor = config["sensors"][name]
+        prefix = "sensors." + name
+        if not isinstance(sensor, dict):
+            errors.append(prefix + " must be an object")
+            continue
+        if not isinstance(sensor.get("enabled"), bool):
+            errors.append(prefix + ".enabled must be true or false")
+        _check_positive(errors, prefix + ".period", sensor.get("period"), integer=False)
+        null_state = sensor.get("null_state")
+        if not isinstance(null_state, dict) or not null_state:
+            errors.append(prefix + ".null_state must list the sensor's keys")
+        elif not all(_is_number(value) for value in null_state.values()):
+            errors.append(prefix + ".null_state values must be numbers")
+        if "sea_level_pressure" in sensor and not _is_number(sensor["sea_level_pressure"]):
+            errors.append(prefix + ".sea_level_pressure must be a number")
+        # The filter settings are optional, a sensor without them is
+        # only checked for null states
+        warmup = sensor.get("warmup", 0)
+        if not _is_number(warmup) or warmup < 0:
+            errors.append(prefix + ".warmup must be a number of seconds, got %r" % (warmup,))
+        max_rate = sensor.get("max_rate", {})
+        if not isinstance(max_rate, dict):
+            errors.append(prefix + ".max_rate must be an object")
+        else:
+            for key in max_rate:
+                if isinstance(null_state, dict) and key not in null_state:
+                    errors.append("%s.max_rate has %r, which isn't one of the sensor's keys" % (prefix, key))
+                elif not _is_number(max_rate[key]) or max_rate[key] <= 0:
+                    errors.append("%s.max_rate.%s must be a positive number" % (prefix, key))
+        if not isinstance(sensor.get("median", False), bool):
+            errors.append(prefix + ".median must be true or false")
+    return errors
+
+
+def load_config(path="/config.json"):
+    '''
+    Read a config file over the defaults and validate it. A missing file
+    means the defaults; a bad one raises ValueError listing every problem
+    '''
+    try:
+        with open(path, "r") as f:
+            overrides = json.load(f)
+    except OSError:
+        print("No config at", path, "running on defaults")
+        overrides = {}
+    if not isinstance(overrides, dict):
+        raise ValueError("Config must be a json object")
+    config = merge_config(DEFAULT_CONFIG, overrides)
+    errors = validate_config(config)
+    if errors:
+        raise ValueError("Bad config in " + path + ": " + "; ".join(errors))
+    return config
@@ -0,0 +1,130 @@
+'''
+Outlier and sensor fault filtering
+
+Sits between Sensor_Array.update_sensors and the packet, so bad frames
+and start up transients are dealt with once on the board rather than
+by every query on the server.
+
+For each key it can:
+    - drop readings from a sensor that failed this pass, instead of
+      passing on its null state (-1, -40) as if it were a reading
+    - reject a value that moved further from the recent median than
+      max_rate per second allows. Rejected values still go into the
+      median window, so a real step change is accepted once it has
+      lasted about half the window
+    - report the median of the last median_window values instead of
+      the raw one, for noisy sensors
+    - flag values from a sensor still inside its declared warm-up
+      window after it was first read (the value is kept)
+
+Every step is a fixed amount of work per key per reading.
+
+Dropped or rejected values become None, and each reading gains two masks
+with one bit per key, bit i for the i-th key in sorted order (filter.keys):
+    valid_mask      the key holds a value that can be trusted
+    warmup_mask     the key's sensor was warming up
+Register every configured sensor, not only the ones that answered at
+boot, so a sensor going missing doesn't shift the bits of the keys after
+its own. A registered key missing from a reading just has its bits clear.
+'''
+
+
+class _Column(object):
+    '''
+    Filter state for one key: a small ring of recent values
+    '''
+    def __init__(self, window, warmup, max_rate, median):
+        self.window = [0.0] * window
+        self.count = 0
+        self.position = 0
+        self.warmup = warmup
+        self.max_rate = max_rate
+        self.median = median
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def current_median(self):
+        values = sorted(self.window[:self.count])
+        return values[self.count // 2]
+
+    def push(self, value):
+        self.window[self.position] = value
+        self.position = (self.position + 1) % len(self.window)
+        if self.count < len(self.window):
+            self.count += 1
+
+
+class Reading_Filter(object):
+    '''
+    Streaming filter over Sensor_Array readings. Register each sensor's
+    keys with add_sensor, then pass every reading through apply.
+    '''
+    def __init__(self, median_window=3):
+        self.median_window = median_window
+        self.keys = []
+        self._columns = {}
+        self._bits = {}
+        self.rejected = 0
+        self.nulls = 0
+
+    def add_sensor(self, keys, warmup=0, max_rates=None, median=False):
+        '''
+        keys are the sensor's reading keys, warmup the seconds after its
+        first reading to flag, max_rates the fastest each key can really
+        change per second (keys left out aren't rate checked), median
+        whether to report the median rather than the raw value
+        '''
+        if max_rates is None:
+            max_rates = {}
+        for key in keys:
+            self._columns[key] = _Column(self.median_window, warmup, max_rates.get(key), median)
+        self.keys = sorted(self._columns)
+        self._bits = {}
+        for i, key in enumerate(self.keys):
+            self._bits[key] = 1 << i
+
+    def apply(self, sensor_readings, invalid_keys=()):
+        '''
+        Filter one reading in place and return it. invalid_keys are the
+        keys of sensors that failed this pass (Sensor_Array.invalid_keys)
+        '''
+        timestamp = sensor_readings['raw_timestamp']
+        valid_mask = 0
+        warmup_mask = 0
+        for key in self.keys:
+            if key not in sensor_readings:
+                continue
+            column = self._columns[key]
+            value = sensor_readings[key]
+            if value is None:
+                continue
+            if key in invalid_keys:
+                # The null state, not a reading
+                sensor_readings[key] = None
+                self.nulls += 1
+                continue
+
+            if column.first_timestamp is None:
+                column.first_timestamp = timestamp
+            if timestamp - column.first_timestamp < column.warmup:
+                warmup_mask |= self._bits[key]
+
+            accept = True
+            if column.max_rate is not None and column.count:
+                elapsed = max(1, timestamp - column.last_timestamp)
+                if abs(value - column.current_median()) > column.max_rate * elapsed:
+                    accept = False
+            column.push(value)
+            column.last_timestamp = timestamp
+
+            if not accept:
+                sensor_readings[key] = None
+                self.rejected += 1
+                continue
+            if column.median:
+                sensor_readings[key] = column.current_median()
+            valid_mask |= self._bits[key]
+
+        sensor_readings['valid_mask'] = valid_mask
+        sensor_readings['warmup_mask'] = warmup_mask
+        return sensor_readings
@@ -0,0 +1,469 @@
+'''
+Compact on-flash history of the sensor readings
+
+Every reading that goes into a Sensors_Packet is also appended here
+as a fixed size binary record, so the history survives the home server
+being down for longer than the packet backlog can cover. The uploader
+can then backfill any gap by reading the range back out.
+
+Readings are kept in retention tiers:
+    raw         1 Hz readings for the last hour
+    minute      1 minute min/max/mean rollups
+    quarter     15 minute min/max/mean rollups
+
+Each tier is a ring file of equal sized blocks. A block is filled in
+ram and written to flash exactly once, aligned to the flash sector size,
+and the ring spreads those writes evenly over the file. Nothing is ever
+rewritten in place to keep an index: the index is rebuilt at boot from
+the block headers, and lets a range read binary search to its first block.
+
+CircuitPython mounts the filesystem read only to code by default, so
+boot.py has to remount it writable (storage.remount("/", False)) for the
+store to be used on the board. Runs unchanged under CPython.
+
+The tiers are sized up front, so with max_bytes (see available_flash)
+their retentions are cut back to fit rather than running the flash out
+part way through filling them.
+'''
+import os
+import json
+import struct
+
+
+# magic, record count, write sequence, first timestamp, last timestamp
+_BLOCK_HEADER = '<2sHIII'
+_BLOCK_HEADER_SIZE = struct.calcsize(_BLOCK_HEADER)
+_BLOCK_MAGIC = b'TS'
+_NAN = float('nan')
+_TIER_FILES = ('raw.bin', 'minute.bin', 'quarter.bin')
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+    except OSError:
+        return False
+    return True
+
+
+def _tier_blocks(record_size, block_size, retention, period):
+    records_per_block = (block_size - _BLOCK_HEADER_SIZE) // record_size
+    # One extra block so a full retention window is still on flash
+    # while the oldest block is being replaced
+    records = retention // period
+    return -(-records // records_per_block) + 1
+
+
+def available_flash(directory, reserve=65536):
+    '''
+    Bytes a Sensor_Store in directory can take: the filesystem's free
+    space plus what the store's own files already hold, less reserve
+    bytes kept back for everything else on the board
+    '''
+    parent = directory.rsplit('/', 1)[0] or '/'
+    stats = os.statvfs(directory if _exists(directory) else parent)
+    available = stats[0] * stats[4]
+    for name in _TIER_FILES:
+        try:
+            available += os.stat(directory + '/' + name)[6]
+        except OSError:
+            pass
+    return max(0, available - reserve)
+
+
+class Series_Tier(object):
+    '''
+    A single retention tier: a ring file of fixed size blocks, each
+    holding a header followed by fixed size struct records whose first
+    field is the timestamp.
+
+    Holds an in ram index of (first timestamp, last timestamp, slot) for
+    every block on flash, oldest first, so range reads are O(log n) to
+    find where to start.
+    '''
+    def __init__(self, path, record_format, block_size, retention, period):
+        self.path = path
+        self.period = period
+        self.block_size = block_size
+        self._record_format = record_format
+        self.record_size = struct.calcsize(record_format)
+        self.records_per_block = (block_size - _BLOCK_HEADER_SIZE) // self.record_size
+        if self.records_per_block < 1:
+            raise ValueError("Block size too small to hold a single record")
+        self.block_count = _tier_blocks(self.record_size, block_size, retention, period)
+
+        self._buffer = bytearray(block_size)
+        self._read_buffer = None
+        self._buffered = 0
+        self._first_ts = 0
+        self._last_ts = 0
+        self._sequence = 0
+        self._next_slot = 0
+        self._index = []
+        self._open()
+
+    def _open(self):
+        if not _exists(self.path):
+            self._file = open(self.path, 'w+b')
+            return
+        self._file = open(self.path, 'r+b')
+
+        # Rebuild the index from the block headers alone
+        header = bytearray(_BLOCK_HEADER_SIZE)
+        blocks = []
+        slot = 0
+        while slot < self.block_count:
+            self._file.seek(slot * self.block_size)
+            if self._file.readinto(header) != _BLOCK_HEADER_SIZE:
+                break
+            magic, count, sequence, first_ts, last_ts = struct.unpack(_BLOCK_HEADER, header)
+            if magic == _BLOCK_MAGIC and count:
+                blocks.append((sequence, first_ts, last_ts, slot))
+            slot += 1
+        blocks.sort()
+        self._index = [(first_ts, last_ts, slot) for sequence, first_ts, last_ts, slot in blocks]
+        if blocks:
+            self._sequence = blocks[-1][0] + 1
+            self._next_slot = (blocks[-1][3] + 1) % self.block_count
+
+    def append_record(self, *fields):
+        '''
+        Pack one record into the ram block, writing the block out to
+        flash once it is full
+        '''
+        timestamp = fields[0]
+        if not self._buffered:
+            self._first_ts = timestamp
+        self._last_ts = timestamp
+        offset = _BLOCK_HEADER_SIZE + self._buffered * self.record_size
+        struct.pack_into(self._record_format, self._buffer, offset, *fields)
+        self._buffered += 1
+        if self._buffered == self.records_per_block:
+            self._write_block()
+            self._buffered = 0
+
+    def _write_block(self):
+        slot = self._next_slot
+        struct.pack_into(_BLOCK_HEADER, self._buffer, 0, _BLOCK_MAGIC,
+                         self._buffered, self._sequence, self._first_ts, self._last_ts)
+        self._file.seek(slot * self.block_size)
+        self._file.write(self._buffer)
+        self._file.flush()
+
+        # The ring is only ever overwritten at its oldest block
+        if self._index and self._index[0][2] == slot:
+            self._index.pop(0)
+        self._index.append((self._first_ts, self._last_ts, slot))
+        self._sequence += 1
+        self._next_slot = (slot + 1) % self.block_count
+
+    def flush(self):
+        '''
+        Write the partially filled ram block to flash. The same slot is
+        written again once the block fills, so this costs an extra flash
+        write and is best kept for shutdown
+        '''
+        if self._buffered:
+            slot = self._next_slot
+            self._write_block()
+            # Keep filling the same block, it has not been committed yet
+            self._index.pop()
+            self._sequence -= 1
+            self._next_slot = slot
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def oldest_timestamp(self):
+        if self._index:
+            return self._index[0][0]
+        if self._buffered:
+            return self._first_ts
+        return None
+
+    def _first_block(self, start):
+        # Binary search for the first block that ends at or after start
+        low = 0
+        high = len(self._index)
+        while low < high:
+            mid = (low + high) // 2
+            if self._index[mid][1] < start:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def records(self, start, end):
+        '''
+        Yields every record with start <= timestamp <= end, oldest first,
+        as the tuple it was packed from
+        '''
+        if self._read_buffer is None:
+            self._read_buffer = bytearray(self.block_size)
+        position = self._first_block(start)
+        while position < len(self._index):
+            first_ts, last_ts, slot = self._index[position]
+            if first_ts > end:
+                return
+            self._file.seek(slot * self.block_size)
+            self._file.readinto(self._read_buffer)
+            count = struct.unpack_from(_BLOCK_HEADER, self._read_buffer, 0)[1]
+            for record in self._unpack_block(self._read_buffer, count, start, end):
+                yield record
+            position += 1
+
+        if self._buffered and self._first_ts <= end and self._last_ts >= start:
+            for record in self._unpack_block(self._buffer, self._buffered, start, end):
+                yield record
+
+    def _unpack_block(self, block, count, start, end):
+        offset = _BLOCK_HEADER_SIZE
+        for _ in range(count):
+            record = struct.unpack_from(self._record_format, block, offset)
+            offset += self.record_size
+            if record[0] > end:
+                return
+            if record[0] >= start:
+                yield record
+
+
+class _Rollup(object):
+    '''
+    Accumulates min/max/mean for each key over one period, and writes
+    a record into its tier when the period rolls over
+    '''
+    def __init__(self, tier, key_count):
+        self.tier = tier
+        self.period = tier.period
+        self._key_count = key_count
+        self.bucket = None
+
+    def _reset(self, bucket):
+        self.bucket = bucket
+        self.samples = 0
+        self.mins = [_NAN] * self._key_count
+        self.maxs = [_NAN] * self._key_count
+        self.sums = [0.0] * self._key_count
+        self.counts = [0] * self._key_count
+
+    def add(self, timestamp, values):
+        bucket = timestamp - timestamp % self.period
+        if bucket != self.bucket:
+            if self.bucket is not None:
+                self.emit()
+            self._reset(bucket)
+        self.samples += 1
+        for i, value in enumerate(values):
+            if value != value:
+                # NaN, no reading for this key
+                continue
+            if self.counts[i]:
+                self.mins[i] = min(self.mins[i], value)
+                self.maxs[i] = max(self.maxs[i], value)
+            else:
+                self.mins[i] = value
+                self.maxs[i] = value
+            self.sums[i] += value
+            self.counts[i] += 1
+
+    def emit(self):
+        fields = [self.bucket, min(self.samples, 0xFFFF)]
+        for i in range(self._key_count):
+            mean = self.sums[i] / self.counts[i] if self.counts[i] else _NAN
+            fields.append(self.mins[i])
+            fields.append(self.maxs[i])
+            fields.append(mean)
+        self.tier.append_record(*fields)
+
+
+class Sensor_Store(object):
+    '''
+    Time-series store for the Sensor_Array readings.
+
+    Takes the same reading dictionaries that Sensors_Packet.update does,
+    keeps one float per key per reading, and hands ranges back as reading
+    dictionaries so a Sensors_Packet can be rebuilt from them for upload.
+
+    Keys are fixed for the life of the store. If the key list changes
+    (a sensor was added or removed) the old history is discarded, since
+    its records no longer line up with the keys.
+
+    With max_bytes, retentions that wouldn't fit are scaled down together
+    until they do. OSError if not even a couple of blocks per tier fit.
+
+    Base Functionality:
+        append
+        read_range
+        oldest_timestamp
+        flush
+        close
+    '''
+    def __init__(self, directory, keys, block_size=4096, raw_retention=3600,
+                 minute_retention=86400, quarter_retention=14*86400, max_bytes=None):
+        self.directory = directory
+        self.keys = [key for key in keys if key != 'raw_timestamp']
+        key_count = len(self.keys)
+        if max_bytes is not None:
+            raw_retention, minute_retention, quarter_retention = self._fit(
+                key_count, block_size, max_bytes, raw_retention, minute_retention, quarter_retention)
+
+        if not _exists(directory):
+            os.mkdir(directory)
+        self._check_manifest(block_size)
+
+        self.raw = Series_Tier(directory + '/raw.bin', '<I' + 'f' * key_count,
+                               block_size, raw_retention, 1)
+        rollup_format = '<IH' + 'fff' * key_count
+        self.minute = Series_Tier(directory + '/minute.bin', rollup_format,
+                                  block_size, minute_retention, 60)
+        self.quarter = Series_Tier(directory + '/quarter.bin', rollup_format,
+                                   block_size, quarter_retention, 900)
+        self.tiers = [self.raw, self.minute, self.quarter]
+        self._rollups = [_Rollup(self.minute, key_count), _Rollup(self.quarter, key_count)]
+
+    @staticmethod
+    def planned_bytes(key_count, block_size, raw_retention, minute_retention, quarter_retention):
+        '''
+        Flash the three tier files take once full
+        '''
+        raw_size = struct.calcsize('<I' + 'f' * key_count)
+        rollup_size = struct.calcsize('<IH' + 'fff' * key_count)
+        blocks = (_tier_blocks(raw_size, block_size, raw_retention, 1)
+                  + _tier_blocks(rollup_size, block_size, minute_retention, 60)
+                  + _tier_blocks(rollup_size, block_size, quarter_retention, 900))
+        return blocks * block_size
+
+    def _fit(self, key_count, block_size, max_bytes, *retentions):
+        periods = (1, 60, 900)
+        planned = self.planned_bytes(key_count, block_size, *retentions)
+        if planned <= max_bytes:
+            return retentions
+        # Smallest store: each tier down to a single period
+        if self.planned_bytes(key_count, block_size, *periods) > max_bytes:
+            raise OSError("Not enough flash for the history store, %d bytes free" % max_bytes)
+        scale = float(max_bytes) / planned
+        while True:
+            fitted = [max(period, int(retention * scale))
+                      for retention, period in zip(retentions, periods)]
+            if self.planned_bytes(key_count, block_size, *fitted) <= max_bytes:
+                break
+            scale *= 0.9
+        print("History store cut to fit %d bytes of flash, retentions %d/%d/%d s" % (
+            max_bytes, fitted[0], fitted[1], fitted[2]))
+        return fitted
+
+    def _check_manifest(self, block_size):
+        manifest_path = self.directory + '/keys.json'
+        manifest = {'keys': self.keys, 'block_size': block_size}
+        try:
+            with open(manifest_path, 'r') as f:
+                if json.load(f) == manifest:
+                    return
+        except (OSError, ValueError):
+            pass
+
+        # Layout changed or first run: start from an empty history
+        for name in _TIER_FILES:
+            path = self.directory + '/' + name
+            if _exists(path):
+                os.remove(path)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+    def append(self, sensor_readings):
+        '''
+        Store one reading from Sensor_Array.update_sensors. Keys missing
+        from the reading are stored as NaN and come back out as None
+        '''
+        timestamp = int(sensor_readings['raw_timestamp'])
+        values = []
+        for key in self.keys:
+            value = sensor_readings.get(key)
+            values.append(_NAN if value is None else float(value))
+        self.raw.append_record(timestamp, *values)
+        for rollup in self._rollups:
+            rollup.add(timestamp, values)
+
+    def oldest_timestamp(self):
+        oldest = [tier.oldest_timestamp() for tier in self.tiers]
+        oldest = [timestamp for timestamp in oldest if timestamp is not None]
+        return min(oldest) if oldest else None
+
+    def _pick_tier(self, start):
+        # Finest tier that still reaches back to start, otherwise
+        # whichever tier holds the longest history
+        longest = None
+        for tier in self.tiers:
+            oldest = tier.oldest_timestamp()
+            if oldest is None:
+                continue
+            if oldest <= start:
+                return tier
+            if longest is None or oldest < longest.oldest_timestamp():
+                longest = tier
+        return longest
+
+    def read_range(self, start, end, limit=None):
+        '''
+        Yields reading dictionaries between start and end (inclusive),
+        oldest first, each part of the range from the finest tier that
+        still holds it. A range reaching back past the raw tier starts in
+        the rollups and carries on in raw once raw's records begin.
+
+        Raw readings come back with the same keys they went in with.
+        Rollups come back as the mean under the original key, plus
+        key + '_min', key + '_max', 'rollup_seconds' and 'samples'
+        '''
+        returned = 0
+        position = start
+        while position <= end:
+            tier = self._pick_tier(position)
+            if tier is None:
+                return
+            # Where a finer tier takes over
+            switch = None
+            for finer in self.tiers[:self.tiers.index(tier)]:
+                oldest = finer.oldest_timestamp()
+                if oldest is not None and (switch is None or oldest < switch):
+                    switch = oldest
+            if tier is self.raw:
+                records = tier.records(position, end)
+            else:
+                # Include the bucket position falls part way into, and the
+                # one the finer tier starts part way into
+                last = end if switch is None else min(end, switch)
+                records = tier.records(position - tier.period + 1, last)
+
+            next_position = position
+            for record in records:
+                if limit is not None and returned >= limit:
+                    return
+                reading = {'raw_timestamp': record[0]}
+                if tier is self.raw:
+                    for key, value in zip(self.keys, record[1:]):
+                        reading[key] = value if value == value else None
+                else:
+                    reading['rollup_seconds'] = tier.period
+                    reading['samples'] = record[1]
+                    offset = 2
+                    for key in self.keys:
+                        low, high, mean = record[offset:offset + 3]
+                        reading[key] = mean if mean == mean else None
+                        reading[key + '_min'] = low if low == low else None
+                        reading[key + '_max'] = high if high == high else None
+                        offset += 3
+                returned += 1
+                next_position = record[0] + reading.get('rollup_seconds', 1)
+                yield reading
+            if switch is None:
+                return
+            position = max(next_position, switch)
+
+    def flush(self):
+        for tier in self.tiers:
+            tier.flush()
+
+    def close(self):
+        for tier in self.tiers:
+            tier.close()
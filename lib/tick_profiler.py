@@ -0,0 +1,205 @@
+'''
+Tick profiler
+
+Nestable timing spans for finding where a tick's time goes: I2C waits
+in a sensor update, UART retries, building the console line, or
+serializing a packet for a post.
+
+Spans are timed with time.monotonic_ns and aggregated as they close into
+a call tree (one node per distinct stack of spans) held in preallocated
+arrays, alongside a ring of the most recent span durations. Recording a
+span writes into those arrays and never grows them, so profiling doesn't
+add garbage to the heap beyond the ints the clock itself returns.
+
+instrument_monitor() wraps the usual suspects of an Air_Quality_Monitor
+in spans. dump() writes the tree and ring as plain text lines, to the
+serial console or appended to a file, and tools/profile_to_flamegraph.py
+turns those dumps into collapsed stacks for flame graph tools.
+
+Dump format, one block per dump:
+    PROFILE begin <dump number>
+    node <index> <parent index> <count> <total ns> <child ns> <span name>
+    span <node index> <duration ns>         (ring, oldest first)
+    PROFILE end
+'''
+import time
+from array import array
+
+
+class Tick_Profiler(object):
+    '''
+    Span recorder. Each span is entered and exited in matching pairs,
+    named once up front with span_id(), or wrapped around a method with
+    wrap(). Spans nested deeper than max_depth, or past max_nodes
+    distinct stacks, are not recorded.
+    '''
+    def __init__(self, capacity=256, max_nodes=64, max_depth=16, clock=time.monotonic_ns):
+        self.capacity = capacity
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self._clock = clock
+        self._names = []
+
+        # Call tree, one node per distinct stack of spans
+        self._node_parent = array('h', [-1] * max_nodes)
+        self._node_span = array('h', [0] * max_nodes)
+        self._node_count = array('l', [0] * max_nodes)
+        self._node_total = array('q', [0] * max_nodes)
+        self._node_child = array('q', [0] * max_nodes)
+        self._nodes = 0
+
+        # Open spans
+        self._stack_node = array('h', [0] * max_depth)
+        self._stack_start = array('q', [0] * max_depth)
+        self._depth = 0
+
+        # Most recent closed spans
+        self._ring_node = array('h', [0] * capacity)
+        self._ring_duration = array('q', [0] * capacity)
+        self._ring_next = 0
+        self._ring_used = 0
+
+        self.dumps = 0
+        self.dropped_spans = 0
+
+    def span_id(self, name):
+        '''
+        Number for a span name, to pass to enter and exit
+        '''
+        if name in self._names:
+            return self._names.index(name)
+        self._names.append(name)
+        return len(self._names) - 1
+
+    def _find_node(self, parent, span):
+        for node in range(self._nodes):
+            if self._node_parent[node] == parent and self._node_span[node] == span:
+                return node
+        if self._nodes == self.max_nodes:
+            return -2
+        node = self._nodes
+        self._node_parent[node] = parent
+        self._node_span[node] = span
+        self._nodes += 1
+        return node
+
+    def enter(self, span):
+        depth = self._depth
+        self._depth = depth + 1
+        if depth >= self.max_depth:
+            return
+        parent = self._stack_node[depth - 1] if depth else -1
+        # A span under an unrecorded span isn't recorded either
+        node = -2 if parent == -2 else self._find_node(parent, span)
+        self._stack_node[depth] = node
+        self._stack_start[depth] = self._clock()
+
+    def exit(self, span):
+        now = self._clock()
+        self._depth -= 1
+        depth = self._depth
+        if depth >= self.max_depth:
+            self.dropped_spans += 1
+            return
+        node = self._stack_node[depth]
+        if node < 0:
+            self.dropped_spans += 1
+            return
+        elapsed = now - self._stack_start[depth]
+        self._node_count[node] += 1
+        self._node_total[node] += elapsed
+        if depth:
+            parent = self._stack_node[depth - 1]
+            if parent >= 0:
+                self._node_child[parent] += elapsed
+
+        position = self._ring_next
+        self._ring_node[position] = node
+        self._ring_duration[position] = elapsed
+        self._ring_next = (position + 1) % self.capacity
+        if self._ring_used < self.capacity:
+            self._ring_used += 1
+
+    def wrap(self, owner, method_name, name=None):
+        '''
+        Replace owner.method_name with a version timed as a span.
+        Wrapping a class times every instance, wrapping an instance
+        times just that one
+        '''
+        method = getattr(owner, method_name)
+        span = self.span_id(name or method_name)
+        profiler = self
+
+        def timed(*args, **kwargs):
+            profiler.enter(span)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                profiler.exit(span)
+
+        setattr(owner, method_name, timed)
+        return timed
+
+    def reset(self):
+        '''
+        Clear the totals and the ring, keeping the span names and the
+        call tree's shape
+        '''
+        for node in range(self._nodes):
+            self._node_count[node] = 0
+            self._node_total[node] = 0
+            self._node_child[node] = 0
+        self._ring_next = 0
+        self._ring_used = 0
+
+    def dump(self, path=None):
+        '''
+        Write the current totals and ring, to the console if path is
+        None, otherwise appended to the file at path
+        '''
+        self.dumps += 1
+        lines = ["PROFILE begin %d" % self.dumps]
+        for node in range(self._nodes):
+            lines.append("node %d %d %d %d %d %s" % (
+                node, self._node_parent[node], self._node_count[node],
+                self._node_total[node], self._node_child[node],
+                self._names[self._node_span[node]]))
+        start = (self._ring_next - self._ring_used) % self.capacity
+        for i in range(self._ring_used):
+            position = (start + i) % self.capacity
+            lines.append("span %d %d" % (self._ring_node[position], self._ring_duration[position]))
+        lines.append("PROFILE end")
+
+        if path is None:
+            for line in lines:
+                print(line)
+        else:
+            with open(path, "a") as f:
+                for line in lines:
+                    f.write(line + "\n")
+
+
+def instrument_monitor(profiler, monitor):
+    '''
+    Wrap an Air_Quality_Monitor's tick, its sensor array and each
+    sensor's update, the reading filter, the packet methods, and the
+    network calls in spans
+    '''
+    # Imported here so the profiler itself doesn't pull in the monitor
+    from air_monitor import Sensors_Packet, Summary_Packet
+
+    profiler.wrap(monitor, 'tick')
+    profiler.wrap(monitor.sensor_array, 'update_sensors')
+    if monitor.reading_filter is not None:
+        profiler.wrap(monitor.reading_filter, 'apply', 'filter readings')
+    for sensor in monitor.sensor_array.list_of_sensors:
+        profiler.wrap(sensor, 'update', 'update ' + sensor.name)
+    for method_name in ('update', 'print_and_update_limited', 'prep_json', 'prep_compact'):
+        profiler.wrap(Sensors_Packet, method_name)
+    profiler.wrap(Summary_Packet, 'update', 'update summary')
+    if monitor.sensor_store is not None:
+        profiler.wrap(monitor.sensor_store, 'append', 'store append')
+    profiler.wrap(monitor.network, 'post_sensor_packet')
+    profiler.wrap(monitor.network, 'get_sea_level')
+    if monitor.network.link is not None:
+        profiler.wrap(monitor.network.link, 'ready', 'link ready')
@@ -0,0 +1,235 @@
+'''
+Uploader backends
+
+Air_Quality_Monitor keeps the backlog of packets and hands the oldest one
+to its uploader every tick until it goes, dropping and backfilling when
+the backlog grows too long. Which way a packet leaves the board is up to
+the uploader, and every uploader shares the same queue, retry and link
+handling through Uploader.post_sensor_packet:
+
+    Current_Web_Status (air_monitor.py)     HTTP POST to the home server
+    MQTT_Uploader                           publish at QoS 1 over one kept
+                                            open connection to a broker
+    File_Uploader                           append to a file on flash, or
+                                            write to a serial stream, for
+                                            units with no network at all
+
+A backend only implements _send(sensor_packet), which raises OSError
+when the link under it failed (the Link_Supervisor backs off) and
+RuntimeError when the far end is there but didn't take the packet.
+Either way the packet stays at the head of the backlog for the next tick.
+
+Packets go out in the uploader's wire_format, "json" or "compact", the
+same payloads Sensors_Packet.prep_json and prep_compact make for HTTP.
+'''
+import os
+import struct
+import time
+
+try:
+    from adafruit_minimqtt.adafruit_minimqtt import MMQTTException
+except ImportError:
+    # Off the board the stand-in client in tools/mqtt_broker.py raises this one
+    class MMQTTException(Exception):
+        pass
+
+
+class Uploader(object):
+    '''
+    Base for the uploader backends. link is the Link_Supervisor for the
+    wifi the backend needs, or None for one that doesn't need a network.
+    status_pixel is the neopixel used to show failed posts.
+    '''
+    def __init__(self, link=None, status_pixel=None, wire_format="json"):
+        self.link = link
+        self._status_pixel = status_pixel
+        self.wire_format = wire_format
+        self.homeserver_is_online = False
+        # Posts that actually tried to send, not ones skipped for the link
+        self.send_attempts = 0
+        self.packets_sent = 0
+        self.failed_sends = 0
+
+    def _show_status(self, color):
+        if self._status_pixel is not None:
+            self._status_pixel[0] = color
+            self._status_pixel.show()
+
+    def payload(self, sensor_packet):
+        '''
+        The packet serialized in this uploader's wire format, a str for
+        json and bytes for compact
+        '''
+        if self.wire_format == "compact":
+            return sensor_packet.prep_compact()
+        return sensor_packet.prep_json()
+
+    def _send(self, sensor_packet):
+        raise NotImplementedError
+
+    def post_sensor_packet(self, sensor_packet):
+        '''
+        Try to send one packet, if the link supervisor thinks it's worth
+        trying. Returns whether it went; a packet that didn't is kept by
+        the caller and tried again later
+        '''
+        if self.link is not None and not self.link.ready():
+            return False
+        self.send_attempts += 1
+        try:
+            # Only serialized once we know it's going somewhere
+            self._send(sensor_packet)
+        except OSError as e:
+            # The link under us, let the supervisor back off
+            if self.link is not None:
+                self.link.report_failure()
+            print("> Os Error Caught", e)
+        except RuntimeError as e:
+            # The far end, server or broker down
+            print("> Runtime Error Caught", e)
+        else:
+            self.packets_sent += 1
+            if self.link is not None:
+                self.link.report_success()
+            self._show_status((0,0,0))
+            return True
+        self.failed_sends += 1
+        self._show_status((100,0,0))
+        return False
+
+    def get_sea_level(self):
+        '''
+        Only the home server knows the sea level pressure
+        '''
+        return None
+
+    def close(self):
+        pass
+
+
+class MQTT_Uploader(Uploader):
+    '''
+    Publishes each packet to topic at QoS 1 over one connection kept open
+    between packets, so a packet costs a PUBLISH and a PUBACK instead of
+    a whole HTTP request and response.
+
+    client_factory makes a connected-on-demand MQTT client: on the board
+    an adafruit_minimqtt.MQTT built on the socket pool, under CPython the
+    Simple_MQTT_Client in tools/mqtt_broker.py. It needs connect(),
+    publish(topic, msg, qos=1) which returns once the PUBACK arrives, and
+    disconnect().
+
+    A publish that isn't acknowledged fails the post, the connection is
+    dropped and made again for the next try. The retried packet may then
+    reach the broker twice, which QoS 1 allows. A connection idle longer
+    than keep_alive is remade before publishing rather than publishing
+    into one the broker has likely given up on.
+    '''
+    def __init__(self, client_factory, topic, link=None, status_pixel=None,
+                 wire_format="json", keep_alive=60, clock=time.monotonic):
+        super().__init__(link, status_pixel, wire_format)
+        self.topic = topic
+        self.keep_alive = keep_alive
+        self._client_factory = client_factory
+        self._clock = clock
+        self._client = None
+        self._last_publish = None
+        self.connections = 0
+
+    @property
+    def connected(self):
+        return self._client is not None
+
+    def _connect(self):
+        client = self._client_factory()
+        try:
+            client.connect()
+        except MMQTTException as e:
+            raise RuntimeError("Broker refused connection: %s" % e)
+        self._client = client
+        self._last_publish = self._clock()
+        self.connections += 1
+
+    def _drop_connection(self):
+        client = self._client
+        self._client = None
+        if client is not None:
+            try:
+                client.disconnect()
+            except (MMQTTException, OSError, RuntimeError):
+                pass
+
+    def _send(self, sensor_packet):
+        if self._client is not None and self._clock() - self._last_publish > self.keep_alive:
+            self._drop_connection()
+        if self._client is None:
+            self._connect()
+        try:
+            self._client.publish(self.topic, self.payload(sensor_packet), qos=1)
+        except MMQTTException as e:
+            self._drop_connection()
+            raise RuntimeError("Publish not acknowledged: %s" % e)
+        except OSError:
+            self._drop_connection()
+            raise
+        self._last_publish = self._clock()
+
+    def close(self):
+        self._drop_connection()
+
+
+class File_Uploader(Uploader):
+    '''
+    For air gapped units: writes each packet to a file on flash (path),
+    or to a stream with a write method (stream), such as usb_cdc.data for
+    a serial line to a logging computer.
+
+    json packets are written one per line. Compact packets are written
+    as a little endian uint32 length and then the packet, since they can
+    hold any byte. Once a file passes max_bytes it is moved to path + ".1",
+    replacing the one before, so flash holds at most two files' worth.
+
+    A failed write (flash full, or read only because boot.py didn't
+    remount it) fails the post, so the packet waits in the backlog.
+    '''
+    def __init__(self, path=None, stream=None, max_bytes=None, status_pixel=None,
+                 wire_format="json"):
+        super().__init__(None, status_pixel, wire_format)
+        if (path is None) == (stream is None):
+            raise ValueError("File_Uploader needs one of a path or a stream")
+        self.path = path
+        self.max_bytes = max_bytes
+        self._stream = stream
+        self.bytes_written = 0
+
+    def _record(self, sensor_packet):
+        payload = self.payload(sensor_packet)
+        if self.wire_format == "compact":
+            return struct.pack('<I', len(payload)) + payload
+        return payload.encode('utf-8') + b'\n'
+
+    def _rotate(self, incoming):
+        try:
+            size = os.stat(self.path)[6]
+        except OSError:
+            # No file yet
+            return
+        if size and size + incoming > self.max_bytes:
+            old_path = self.path + ".1"
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+            os.rename(self.path, old_path)
+
+    def _send(self, sensor_packet):
+        record = self._record(sensor_packet)
+        if self._stream is not None:
+            self._stream.write(record)
+        else:
+            if self.max_bytes is not None:
+                self._rotate(len(record))
+            # Opened per packet so a power cut loses at most the one being written
+            with open(self.path, "ab") as f:
+                f.write(record)
+        self.bytes_written += len(record)
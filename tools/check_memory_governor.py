@@ -0,0 +1,179 @@
+'''
+Check the memory governor against a simulated heap
+
+Runs lib/memory_governor.py's Memory_Governor over a Simulated_Heap, first
+on its own and then under a real Air_Quality_Monitor whose backlog takes
+heap as it grows through an upload outage:
+
+    - each threshold crossed steps the level up, one level per threshold
+    - a level only steps back down once free memory is hysteresis bytes
+      past its threshold
+    - released memory is collected before it is counted as short
+    - lowest_free is the least free memory any sample saw
+    - through an outage the monitor cuts its packets to a quarter, then
+      switches to full size summary packets, then spills the backlog,
+      without a MemoryError, and is back to normal once the backlog drains
+
+    python tools/check_memory_governor.py
+
+Prints each check as it passes and exits non zero on the first failure.
+'''
+import contextlib
+import io
+import os
+import sys
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'lib'))
+
+from air_monitor import Sensor, Sensor_Array, Summary_Packet, Air_Quality_Monitor
+from memory_governor import (Memory_Governor, Simulated_Heap, MEMORY_NORMAL, MEMORY_SMALL_PACKETS,
+                             MEMORY_SUMMARY_ONLY, MEMORY_SPILL_BACKLOG, MEMORY_QUIET)
+from uploaders import File_Uploader
+
+
+THRESHOLDS = (65536, 49152, 32768, 16384)
+HYSTERESIS = 8192
+BUDGET = 100000
+
+# Rough heap cost of what the monitor holds: a reading's worth of floats
+# and list slots in a Sensors_Packet, and a whole Summary_Packet
+READING_BYTES = 400
+SUMMARY_BYTES = 1200
+
+
+def check(condition, description):
+    if not condition:
+        sys.exit("FAIL " + description)
+    print("ok   " + description)
+
+
+def make_governor(heap):
+    return Memory_Governor(mem_free=heap.mem_free, collect=heap.collect,
+                           thresholds=THRESHOLDS, hysteresis=HYSTERESIS)
+
+
+def quietly(call, *args):
+    # The governor and monitor print level changes, as they do on the board
+    with contextlib.redirect_stdout(io.StringIO()):
+        return call(*args)
+
+
+def check_governor():
+    heap = Simulated_Heap(BUDGET)
+    governor = make_governor(heap)
+    frees = []
+
+    levels = []
+    for step in range(BUDGET // 1024 - 1):
+        heap.allocate(1024)
+        levels.append(quietly(governor.sample))
+        frees.append(governor.free)
+    stepped = [level for i, level in enumerate(levels) if i == 0 or level != levels[i - 1]]
+    check(stepped == [MEMORY_NORMAL, MEMORY_SMALL_PACKETS, MEMORY_SUMMARY_ONLY,
+                      MEMORY_SPILL_BACKLOG, MEMORY_QUIET], "levels step up one threshold at a time")
+    first_quiet = levels.index(MEMORY_QUIET)
+    check(frees[first_quiet] < THRESHOLDS[3] <= frees[first_quiet - 1],
+          "quiet starts as free memory drops under its threshold")
+
+    # Free back up to just short of the hysteresis margin
+    heap.release(heap.used - (BUDGET - THRESHOLDS[3] - HYSTERESIS + 1))
+    check(quietly(governor.sample) == MEMORY_QUIET and governor.free == THRESHOLDS[3] + HYSTERESIS - 1
+          and governor.collections > 0, "released memory collected, level held inside the hysteresis")
+    frees.append(governor.free)
+    heap.release(1)
+    check(quietly(governor.sample) == MEMORY_SPILL_BACKLOG, "steps down once past the hysteresis")
+    frees.append(governor.free)
+
+    heap.release(heap.used)
+    check(quietly(governor.sample) == MEMORY_NORMAL and governor.highest_level == MEMORY_QUIET,
+          "back to normal with the memory free, highest level kept")
+    frees.append(governor.free)
+    check(governor.lowest_free == min(frees), "lowest_free is the least free memory sampled")
+
+
+class Sink(object):
+    '''
+    Stream for File_Uploader that fails while the outage lasts. What it
+    writes is allocated and released on the heap, the way a post's
+    serialized packet is garbage once it's sent
+    '''
+    def __init__(self, heap):
+        self.heap = heap
+        self.down = False
+
+    def write(self, record):
+        if self.down:
+            raise OSError("Outage")
+        self.heap.allocate(len(record))
+        self.heap.release(len(record))
+
+
+def held_bytes(monitor):
+    held = 0
+    for pack in [monitor.sensor_pack] + monitor.packets_to_post:
+        if isinstance(pack, Summary_Packet):
+            held += SUMMARY_BYTES
+        else:
+            held += READING_BYTES * pack.pack_size
+    return held
+
+
+def check_monitor():
+    now = [0]
+    sensor = Sensor("bme280")
+    sensor.set_null_state(null_readings={'temp_c': -40, 'humidity': -1, 'pressure': -1})
+    sensor.set_update(lambda state: {'temp_c': 21.0, 'humidity': 40.0, 'pressure': 1000.0})
+    sensor.sensor = None
+    sensor.is_connected = True
+    sensor_array = Sensor_Array([sensor], clock=lambda: now[0])
+
+    heap = Simulated_Heap(BUDGET, used=20000)
+    governor = make_governor(heap)
+    sink = Sink(heap)
+    monitor = Air_Quality_Monitor(sensor_array, File_Uploader(stream=sink), packet_size_limit=20,
+                                  backlog_limit=1000, verbose=False, memory_governor=governor)
+
+    levels = []
+    limits = {}
+    summaries = 0
+    frees = []
+    held = 0
+    sink.down = True
+    try:
+        for now[0] in range(1, 3000):
+            if now[0] == 2000:
+                sink.down = False
+            quietly(monitor.tick)
+            # The heap follows what the monitor now holds
+            now_held = held_bytes(monitor)
+            if now_held > held:
+                heap.allocate(now_held - held)
+            else:
+                heap.release(held - now_held)
+            held = now_held
+            levels.append(governor.level)
+            frees.append(governor.free)
+            limits.setdefault(governor.level, set()).add(monitor._packet_limit)
+            if isinstance(monitor.sensor_pack, Summary_Packet):
+                summaries += 1
+    except MemoryError as e:
+        sys.exit("FAIL monitor ran out of memory at %d s: %s" % (now[0], e))
+
+    check(max(levels) >= MEMORY_SPILL_BACKLOG, "outage backlog drives the level up to spilling it")
+    check(limits[MEMORY_SMALL_PACKETS] == {5}, "packets cut to a quarter at small packets")
+    check(summaries and limits[MEMORY_SUMMARY_ONLY] == {20}, "summary packets fill to the full limit")
+    check(monitor.dropped_packets > 0, "backlog spilled")
+    check(not monitor.packets_to_post and levels[-1] == MEMORY_NORMAL,
+          "backlog drained and back to normal after the outage")
+    check(governor.lowest_free == min(frees), "lowest_free is the least free memory the monitor saw")
+
+
+def main():
+    check_governor()
+    check_monitor()
+    print("All memory governor checks passed")
+
+
+if __name__ == '__main__':
+    main()
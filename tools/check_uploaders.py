@@ -0,0 +1,155 @@
+'''
+Check the uploader backends against the stand-in broker and a scratch directory
+
+Runs lib/uploaders.py's MQTT_Uploader against tools/mqtt_broker.py's
+MQTT_Broker in a background thread, through Simple_MQTT_Client, and
+File_Uploader against a temporary directory and an in memory stream:
+
+    - json and compact packets published at QoS 1 land in the broker's
+      home server store, over one connection
+    - a connection idle past keep_alive is remade before publishing
+    - packets are passed on to a subscriber
+    - a post while the broker is gone fails and drops the connection,
+      and the next one after it is back reconnects and goes through
+    - the file sink rotates at max_bytes, frames compact packets with
+      their length, and fails (so the packet is kept) when it can't write
+
+    python tools/check_uploaders.py
+
+Prints each check as it passes and exits non zero on the first failure.
+Requires numpy, for the home server stand-in.
+'''
+import contextlib
+import io
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'lib'))
+
+from air_monitor import Sensors_Packet
+from uploaders import MQTT_Uploader, File_Uploader
+from home_server import Home_Server
+from mqtt_broker import (MQTT_Broker, Simple_MQTT_Client, make_packet, encode_string,
+                         CONNECT, SUBSCRIBE)
+
+
+def make_sensor_packet(first_timestamp, readings=3):
+    packet = Sensors_Packet()
+    for i in range(readings):
+        packet.update({'raw_timestamp': first_timestamp + i, 'temp_c': 20.0 + i, 'CO2': None})
+    return packet
+
+
+def check(condition, description):
+    if not condition:
+        sys.exit("FAIL " + description)
+    print("ok   " + description)
+
+
+def subscribe(port, topic_filter):
+    '''
+    A bare socket subscribed to topic_filter, for watching what the
+    broker passes on
+    '''
+    subscriber = socket.create_connection(('127.0.0.1', port), timeout=5)
+    subscriber.sendall(make_packet(CONNECT, encode_string('MQTT') + struct.pack('>BBH', 4, 0x02, 60)
+                                   + encode_string('watcher')))
+    subscriber.recv(4)
+    subscriber.sendall(make_packet(SUBSCRIBE, struct.pack('>H', 1) + encode_string(topic_filter)
+                                   + b'\x00', 0x02))
+    subscriber.recv(5)
+    return subscriber
+
+
+def check_mqtt(directory):
+    server = Home_Server(os.path.join(directory, 'server'))
+    broker = MQTT_Broker(server)
+    port = broker.serve_in_background()
+    subscriber = subscribe(port, 'air_monitor/+/packets')
+
+    now = [0]
+    uploader = MQTT_Uploader(lambda: Simple_MQTT_Client('127.0.0.1', port, client_id='check-1'),
+                             'air_monitor/check-1/packets', keep_alive=60, clock=lambda: now[0])
+    check(uploader.post_sensor_packet(make_sensor_packet(100))
+          and uploader.post_sensor_packet(make_sensor_packet(103)),
+          "json packets published at QoS 1")
+    uploader.wire_format = 'compact'
+    check(uploader.post_sensor_packet(make_sensor_packet(106)), "compact packet published")
+    check(uploader.connections == 1, "one connection kept open between packets")
+
+    now[0] = 120
+    check(uploader.post_sensor_packet(make_sensor_packet(109)) and uploader.connections == 2,
+          "connection idle past keep_alive remade before publishing")
+
+    stored = server.stores['check-1'].query(0, 1e9, ['temp_c'])
+    check(stored['raw_timestamp'] == [float(t) for t in range(100, 112)]
+          and broker.bad_payloads == 0, "broker stored every row, json and compact")
+
+    subscriber.settimeout(2)
+    forwarded = subscriber.recv(65536)
+    check(forwarded[:1] == b'\x30' and b'air_monitor/check-1/packets' in forwarded,
+          "packets passed on to a subscriber")
+    subscriber.close()
+
+    broker.stop()
+    # The uploader prints what went wrong, as it does on the board
+    with contextlib.redirect_stdout(io.StringIO()):
+        posted = uploader.post_sensor_packet(make_sensor_packet(200))
+    check(not posted and not uploader.connected and uploader.failed_sends == 1,
+          "post fails and drops the connection while the broker is gone")
+
+    broker = MQTT_Broker(server)
+    broker.serve_in_background(port=port)
+    check(uploader.post_sensor_packet(make_sensor_packet(200)) and uploader.connections == 3,
+          "reconnects and publishes once the broker is back")
+    uploader.close()
+    broker.stop()
+    server.stop()
+
+
+def check_file_sink(directory):
+    path = os.path.join(directory, 'packets.log')
+    uploader = File_Uploader(path=path, max_bytes=200)
+    for i in range(5):
+        uploader.post_sensor_packet(make_sensor_packet(i * 10))
+    check(sorted(os.listdir(directory)) == ['packets.log', 'packets.log.1']
+          and os.path.getsize(path) <= 200, "file rotated at max_bytes")
+    with open(path) as f:
+        check(json.loads(f.readline())['raw_timestamp'] == [40, 41, 42],
+              "json packets written one per line")
+
+    stream = io.BytesIO()
+    uploader = File_Uploader(stream=stream, wire_format='compact')
+    uploader.post_sensor_packet(make_sensor_packet(0))
+    uploader.post_sensor_packet(make_sensor_packet(5))
+    data = stream.getvalue()
+    length, = struct.unpack_from('<I', data)
+    check(data[4:6] == b'AQ' and len(data) == 2 * (length + 4),
+          "compact packets framed with their length")
+
+    uploader = File_Uploader(path=os.path.join(directory, 'missing', 'packets.log'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        posted = uploader.post_sensor_packet(make_sensor_packet(0))
+    check(not posted and uploader.failed_sends == 1, "unwritable file fails the post")
+
+
+def main():
+    directory = tempfile.mkdtemp(prefix='check_uploaders_')
+    try:
+        check_mqtt(directory)
+        sink_directory = os.path.join(directory, 'sink')
+        os.mkdir(sink_directory)
+        check_file_sink(sink_directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print("All uploader checks passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,483 @@
+'''
+Fleet load simulator for the upload path
+
+Spins up N virtual monitors in one run, each running the real
+Sensor_Array, Sensors_Packet, Current_Web_Status and Air_Quality_Monitor
+from lib/air_monitor.py against simulated sensors, a simulated radio, and
+the home server stand-in (tools/home_server.py) over real HTTP, or with
+--uploader mqtt, publishing through the MQTT_Uploader to the stand-in
+broker (tools/mqtt_broker.py), which stores into the same server.
+
+Time is simulated: every device ticks once per simulated second, so a
+fifteen minute run takes as long as the requests take, not fifteen
+minutes. Devices boot at staggered times, the way a real fleet drifts
+apart, and outages are applied to every device at the same simulated
+second to show the reconnect herd that follows. Devices can be spread
+over worker processes with --workers.
+
+    python tools/fleet_simulator.py --devices 200 --duration 900 \
+        --wifi-outage 300:120 --server-outage 600:60 --workers 4
+
+Reports, per simulated second, the requests (or publishes) reaching the
+server and the total backlog, and for the run the peak against the steady rate, backlog
+depth per device, and where readings were lost.
+
+If a device raises out of its loop it is counted as a crash, loses
+whatever it held in ram, and boots again on the next tick, as a board
+reset would.
+
+Requires numpy, for the home server stand-in.
+'''
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'lib'))
+
+from air_monitor import Sensor, Sensor_Array, Current_Web_Status, Air_Quality_Monitor
+from link_supervisor import Link_Supervisor, Simulated_Radio
+from sensor_store import Sensor_Store
+from uploaders import MQTT_Uploader, MMQTTException
+from home_server import Home_Server
+from mqtt_broker import MQTT_Broker, Simple_MQTT_Client
+
+
+# Simulated clocks start from a fixed epoch so runs are repeatable
+SIMULATION_EPOCH = 1700000000
+
+
+class Outage_Schedule(object):
+    '''
+    Windows of simulated seconds, [start, end), during which the wifi
+    network or the home server is down for every device at once
+    '''
+    def __init__(self, wifi=(), server=()):
+        self.wifi = list(wifi)
+        self.server = list(server)
+
+    def wifi_down(self, t):
+        return any(start <= t < end for start, end in self.wifi)
+
+    def server_down(self, t):
+        return any(start <= t < end for start, end in self.server)
+
+    def first_outage(self):
+        starts = [start for start, end in self.wifi + self.server]
+        return min(starts) if starts else None
+
+
+class Simulated_Clock(object):
+    def __init__(self):
+        self.tick = 0
+
+    def time(self):
+        return SIMULATION_EPOCH + self.tick
+
+
+class Simulated_Response(object):
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+    def close(self):
+        pass
+
+
+# post() takes json= like adafruit_requests, which hides the module
+_json_dumps = json.dumps
+
+
+class Simulated_Session(object):
+    '''
+    Stands in for adafruit_requests.Session, sending requests to the home
+    server stand-in over one kept alive connection, and failing them the
+    way the board sees failures while the wifi or the server is down
+    '''
+    def __init__(self, device_id, radio, host, port, clock, schedule, stats):
+        self.device_id = device_id
+        self.radio = radio
+        self.host = host
+        self.port = port
+        self.clock = clock
+        self.schedule = schedule
+        self.stats = stats
+        self._connection = None
+
+    def _request(self, method, url, body=None, content_type='application/json'):
+        tick = self.clock.tick
+        if not self.radio.connected:
+            raise OSError(113, "No route to host")
+        if self.schedule.server_down(tick):
+            raise RuntimeError("Sending request failed")
+
+        self.stats['requests'][tick] += 1
+        if self._connection is None:
+            self._connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        headers = {'X-Device-Id': self.device_id, 'Content-Type': content_type}
+        try:
+            self._connection.request(method, urlsplit(url).path, body, headers)
+            response = self._connection.getresponse()
+            text = response.read().decode()
+        except (http.client.HTTPException, OSError) as e:
+            self._connection.close()
+            self._connection = None
+            raise OSError("Connection to home server failed: %s" % e)
+        if response.status >= 500:
+            raise RuntimeError("Home server replied %d" % response.status)
+        return Simulated_Response(response.status, text)
+
+    def get(self, url):
+        return self._request('GET', url)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def post(self, url, json=None, data=None, headers=None):
+        if data is not None:
+            content_type = (headers or {}).get('Content-Type', 'application/octet-stream')
+            return self._request('POST', url, data, content_type)
+        return self._request('POST', url, _json_dumps(json))
+
+
+class Simulated_MQTT_Client(Simple_MQTT_Client):
+    '''
+    Simple_MQTT_Client to the stand-in broker, failing the way the board
+    sees failures while the wifi or the broker is down
+    '''
+    def __init__(self, device_id, radio, host, port, clock, schedule, stats):
+        super().__init__(host, port, client_id=device_id)
+        self.radio = radio
+        self.clock = clock
+        self.schedule = schedule
+        self.stats = stats
+
+    def _check(self):
+        if not self.radio.connected:
+            raise OSError(113, "No route to host")
+        if self.schedule.server_down(self.clock.tick):
+            raise MMQTTException("Broker unavailable")
+
+    def connect(self):
+        self._check()
+        super().connect()
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self._check()
+        self.stats['requests'][self.clock.tick] += 1
+        super().publish(topic, msg, retain, qos)
+
+
+def _simulated_sensors(rng):
+    '''
+    A bme280 and an scd4x that random walk around indoor values, with
+    the same keys and null states code.py gives the real ones
+    '''
+    def read_bme(state):
+        state['temp_c'] += rng.uniform(-0.05, 0.05)
+        state['humidity'] += rng.uniform(-0.2, 0.2)
+        state['pressure'] += rng.uniform(-0.1, 0.1)
+        return {'pressure': state['pressure'], 'humidity': state['humidity'],
+                'temp_c': state['temp_c']}
+
+    def read_scd4x(state):
+        if rng.random() < 0.2:
+            # sensor's not ready
+            raise RuntimeError
+        state['CO2'] = max(400, state['CO2'] + rng.randint(-5, 5))
+        return {'CO2': state['CO2'], 'SCD4X_temp': state['temp_c'],
+                'SCD4x_humidity': state['humidity']}
+
+    state = {'temp_c': rng.uniform(19, 24), 'humidity': rng.uniform(30, 50),
+             'pressure': rng.uniform(990, 1020), 'CO2': rng.randint(450, 900)}
+
+    bme280 = Sensor("bme280")
+    bme280.set_null_state(null_readings={'temp_c':-40, 'humidity':-1, 'pressure':-1})
+    bme280.set_update(read_bme)
+    bme280.sensor = state
+    bme280.is_connected = True
+
+    scd4x = Sensor("SCD4x")
+    scd4x.set_null_state(null_readings={'CO2':-1, "SCD4X_temp":-40, "SCD4x_humidity":-1})
+    scd4x.set_update(read_scd4x)
+    scd4x.sensor = state
+    scd4x.is_connected = True
+    return [bme280, scd4x]
+
+
+class Simulated_Device(object):
+    '''
+    One virtual monitor: the same setup code.py does at boot, built on
+    simulated hardware
+    '''
+    def __init__(self, device_id, boot_tick, host, port, schedule, stats, options):
+        self.device_id = device_id
+        self.boot_tick = boot_tick
+        self.host = host
+        self.port = port
+        self.schedule = schedule
+        self.stats = stats
+        self.options = options
+        self.clock = Simulated_Clock()
+        # Sensors and backoff jitter both draw from this, so a --seed run repeats
+        self.rng = random.Random("%d:%s" % (options['seed'], device_id))
+        self.sensors = _simulated_sensors(self.rng)
+        self.radio = Simulated_Radio()
+        self.monitor = None
+        self.max_backlog = 0
+        self._store_directory = None
+        self._session = None
+
+    def boot(self):
+        link = Link_Supervisor(self.radio, {'ssid': 'simulated', 'password': ''},
+                               ping_address=self.host, clock=self.clock.time, rng=self.rng)
+        if self.options['uploader'] == 'mqtt':
+            network = MQTT_Uploader(lambda: Simulated_MQTT_Client(self.device_id, self.radio,
+                                                                  self.host, self.port, self.clock,
+                                                                  self.schedule, self.stats),
+                                    "air_monitor/%s/packets" % self.device_id, link=link,
+                                    wire_format=self.options['wire_format'], clock=self.clock.time)
+            link.connect()
+        else:
+            self._session = Simulated_Session(self.device_id, self.radio, self.host, self.port,
+                                              self.clock, self.schedule, self.stats)
+            network = Current_Web_Status(self.radio, lambda radio: None, lambda pool: self._session,
+                                         base_url="http://%s:%d/" % (self.host, self.port),
+                                         link=link, wire_format=self.options['wire_format'])
+            network.connect_with_mywifi()
+            network.start_sessions_pool()
+
+        sensor_array = Sensor_Array(self.sensors, clock=self.clock.time)
+        sensor_store = None
+        if self.options['with_store']:
+            if self._store_directory is None:
+                self._store_directory = tempfile.mkdtemp(prefix='fleet_store_')
+            # The flash history outlives a reset
+            sensor_store = Sensor_Store(self._store_directory, sensor_array.reading_keys(),
+                                        block_size=1024)
+        self.monitor = Air_Quality_Monitor(sensor_array, network, sensor_store,
+                                           packet_size_limit=self.options['packet_size_limit'],
+                                           backlog_limit=self.options['backlog_limit'],
+                                           verbose=False)
+
+    def held_readings(self):
+        if self.monitor is None:
+            return 0
+        return (self.monitor.sensor_pack.pack_size
+                + sum(pack.pack_size for pack in self.monitor.packets_to_post))
+
+    def tick(self, t):
+        self.clock.tick = t
+        if self.schedule.wifi_down(t):
+            self.radio.drop()
+        else:
+            self.radio.restore()
+        if t < self.boot_tick:
+            return 0
+        self.stats['expected_readings'] += 1
+        if self.monitor is None:
+            try:
+                self.boot()
+            except Exception:
+                # code.py can't get past connecting at boot either
+                self.stats['missed_while_down'] += 1
+                return 0
+        try:
+            self.monitor.tick()
+        except Exception:
+            # Out of the main loop, the board stops until it is reset
+            self.stats['crashes'] += 1
+            self.stats['lost_in_crash'] += self.held_readings()
+            self.stats['dropped_readings'] += self.monitor.dropped_readings
+            self.monitor = None
+            return 0
+        depth = len(self.monitor.packets_to_post)
+        self.max_backlog = max(self.max_backlog, depth)
+        return depth
+
+    def finish(self):
+        if self.monitor is not None:
+            self.monitor.network.close()
+            if self._session is not None:
+                self._session.close()
+            self.stats['dropped_readings'] += self.monitor.dropped_readings
+            self.stats['pending_readings'] += self.held_readings()
+            if self.monitor.sensor_store is not None:
+                self.stats['pending_backfill'] += len(self.monitor.backfill_ranges)
+                self.monitor.sensor_store.close()
+        if self._store_directory is not None:
+            shutil.rmtree(self._store_directory, ignore_errors=True)
+
+
+def run_shard(shard):
+    '''
+    Run a group of devices for the whole simulation and return their
+    statistics. Called in a worker process when --workers is above one
+    '''
+    device_ids, boot_ticks, host, port, schedule, options = shard
+    duration = options['duration']
+    stats = {'requests': [0] * duration, 'backlog': [0] * duration,
+             'expected_readings': 0, 'dropped_readings': 0, 'lost_in_crash': 0,
+             'missed_while_down': 0, 'pending_readings': 0, 'pending_backfill': 0,
+             'crashes': 0, 'max_backlog': []}
+    devices = [Simulated_Device(device_id, boot_tick, host, port, schedule, stats, options)
+               for device_id, boot_tick in zip(device_ids, boot_ticks)]
+
+    # The monitor prints from every post, keep the report readable
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for t in range(duration):
+            stats['backlog'][t] = sum(device.tick(t) for device in devices)
+        for device in devices:
+            device.finish()
+    stats['max_backlog'] = [device.max_backlog for device in devices]
+    return stats
+
+
+def merge_stats(results):
+    merged = results[0]
+    for stats in results[1:]:
+        for key, value in stats.items():
+            if key in ('requests', 'backlog'):
+                merged[key] = [a + b for a, b in zip(merged[key], value)]
+            else:
+                merged[key] += value
+    return merged
+
+
+def report(stats, server, schedule, options):
+    requests = stats['requests']
+    duration = options['duration']
+    first_outage = schedule.first_outage()
+    # Steady rate from after every device has booted until the first outage
+    steady_start = min(options['packet_size_limit'], duration - 1)
+    steady_end = first_outage if first_outage else duration
+    steady = requests[steady_start:steady_end] or requests
+    steady_rate = sum(steady) / float(len(steady))
+    peak = max(requests)
+    peak_at = requests.index(peak)
+
+    print("Simulated %d devices for %d s" % (options['devices'], duration))
+    if schedule.wifi:
+        print("  wifi outages:   " + ", ".join("%d-%d s" % window for window in schedule.wifi))
+    if schedule.server:
+        print("  server outages: " + ", ".join("%d-%d s" % window for window in schedule.server))
+    print()
+    print("Server publishes" if options["uploader"] == "mqtt" else "Server requests")
+    print("  total            %d" % sum(requests))
+    print("  steady rate      %.1f /s" % steady_rate)
+    print("  peak             %d /s at %d s (%.1fx steady)"
+          % (peak, peak_at, peak / steady_rate if steady_rate else float('inf')))
+    print()
+    print("Backlog (packets waiting on a device)")
+    print("  max per device   %d" % max(stats['max_backlog']))
+    print("  mean of maxes    %.1f" % (sum(stats['max_backlog']) / float(len(stats['max_backlog']))))
+    print("  fleet peak       %d" % max(stats['backlog']))
+    print()
+    expected = stats['expected_readings']
+    # Rollup rows (backfilled from the store's coarser tiers, or summary
+    # packets) count as the readings they summarise. Loss is counted from
+    # what never arrived rather than by adding up the drops. A bucket at
+    # the edge of a gap also covers readings that arrived raw, so
+    # delivered can come out a little over what was taken
+    delivered = server.readings_received
+    lost = max(0, expected - delivered - stats['pending_readings'])
+    print("Readings")
+    print("  taken or due     %d" % expected)
+    print("  delivered        %d" % delivered)
+    print("    as rollups     %d in %d rows" % (server.rollup_readings_received,
+                                               server.rollup_rows_received))
+    print("  still on device  %d" % stats['pending_readings'])
+    print("  dropped backlog  %d" % stats['dropped_readings'])
+    print("  lost in crashes  %d (%d crashes)" % (stats['lost_in_crash'], stats['crashes']))
+    print("  missed while down %d" % stats['missed_while_down'])
+    if options['with_store']:
+        print("  gaps left to backfill %d" % stats['pending_backfill'])
+    print("  data loss        %.2f%%" % (100.0 * lost / expected if expected else 0))
+
+    if options['timeline']:
+        print()
+        print("second  requests  backlog")
+        for t in range(duration):
+            print("%6d  %8d  %7d" % (t, requests[t], stats['backlog'][t]))
+
+
+def _window(text):
+    start, length = text.split(':')
+    return (int(start), int(start) + int(length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of monitors posting to one home server")
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--duration', type=int, default=600, help="Simulated seconds")
+    parser.add_argument('--wifi-outage', type=_window, action='append', default=[],
+                        metavar='START:SECONDS', help="Wifi down for every device, repeatable")
+    parser.add_argument('--server-outage', type=_window, action='append', default=[],
+                        metavar='START:SECONDS', help="Home server down, repeatable")
+    parser.add_argument('--packet-size-limit', type=int, default=20)
+    parser.add_argument('--backlog-limit', type=int, default=10)
+    parser.add_argument('--wire-format', choices=('json', 'compact'), default='json')
+    parser.add_argument('--uploader', choices=('http', 'mqtt'), default='http',
+                        help="Post over HTTP, or publish through the stand-in MQTT broker")
+    parser.add_argument('--with-store', action='store_true',
+                        help="Give every device a Sensor_Store so dropped packets get backfilled")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes to spread devices over")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeline', action='store_true', help="Print per second counts")
+    args = parser.parse_args()
+
+    schedule = Outage_Schedule(wifi=args.wifi_outage, server=args.server_outage)
+    options = {'devices': args.devices, 'duration': args.duration,
+               'packet_size_limit': args.packet_size_limit,
+               'backlog_limit': args.backlog_limit, 'with_store': args.with_store,
+               'wire_format': args.wire_format, 'uploader': args.uploader,
+               'seed': args.seed,
+               'timeline': args.timeline}
+
+    rng = random.Random(args.seed)
+    device_ids = ['sim-%04d' % i for i in range(args.devices)]
+    boot_ticks = [rng.randrange(args.packet_size_limit) for _ in device_ids]
+
+    data_directory = tempfile.mkdtemp(prefix='fleet_server_')
+    server = Home_Server(data_directory)
+    broker = None
+    if args.uploader == 'mqtt':
+        # The broker stores into the server, which doesn't need to listen
+        broker = MQTT_Broker(server)
+        port = broker.serve_in_background()
+    else:
+        port = server.serve_in_background()
+    try:
+        workers = max(1, min(args.workers, args.devices))
+        shards = [(device_ids[i::workers], boot_ticks[i::workers], '127.0.0.1', port,
+                   schedule, options) for i in range(workers)]
+        if workers == 1:
+            results = [run_shard(shards[0])]
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(run_shard, shards))
+        stats = merge_stats(results)
+    finally:
+        if broker is not None:
+            broker.stop()
+        server.stop()
+        shutil.rmtree(data_directory, ignore_errors=True)
+
+    report(stats, server, schedule, options)
+
+
+if __name__ == '__main__':
+    main()
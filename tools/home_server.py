@@ -0,0 +1,454 @@
+'''
+Stand-in for the home server the monitors talk to
+
+Runs under CPython (not on the board) and implements the two endpoints
+code.py uses:
+    POST /enviornmental_sensors     sensor packets from Sensors_Packet
+    GET  /api/weather_status        sea level pressure for the bme280
+
+plus a range query endpoint to read the history back out:
+    GET  /api/sensors?start=<t>&end=<t>[&keys=a,b][&device=<id>]
+
+Packets are accepted as the Sensors_Packet dictionary, as that dictionary
+already json encoded into a json string (which is what code.py sends,
+since it hands prep_json() to the json argument of post), or as a json
+list of either for bulk uploads. Packets in the compact binary format
+(Sensors_Packet.prep_compact) are accepted as application/octet-stream,
+one or more back to back. Every packet in a request is decoded into
+NumPy columns in one go and appended to columnar storage on disk: one
+memory mapped float64 array per sensor key, per device. Devices are told
+apart by an X-Device-Id header, falling back to their address. Ids are
+used as directory names, so only letters, digits, _ . and - are accepted.
+
+Everything runs on a single asyncio loop, so hundreds of simulated
+monitors can hold connections open at once. It can be run on its own:
+    python tools/home_server.py --port 5000 --data server_data
+or started in a background thread by tests and benchmarks with
+Home_Server.serve_in_background().
+
+Requires numpy.
+'''
+import argparse
+import asyncio
+import json
+import os
+import re
+import struct
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+
+# Device ids become directory names, so nothing that can climb out of
+# the data directory
+_DEVICE_ID = re.compile(r'[A-Za-z0-9_.-]+\Z')
+
+
+class Column_Store(object):
+    '''
+    Columnar on-disk storage for one device.
+
+    Each key gets its own memory mapped float64 file, all holding the
+    same number of rows, so a reading missing a key is stored as NaN.
+    Files grow in chunks of rows rather than per append.
+    '''
+    def __init__(self, directory, chunk_rows=4096):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        os.makedirs(directory, exist_ok=True)
+        self._meta_path = os.path.join(directory, 'meta.json')
+        self._columns = {}
+        self.rows = 0
+        self.capacity = 0
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            self.rows = meta['rows']
+            self.capacity = meta['capacity']
+            for key in meta['keys']:
+                self._columns[key] = self._map(key)
+
+    def _column_path(self, key):
+        # Sensor keys contain spaces, keep the filenames tame
+        return os.path.join(self.directory, key.replace(' ', '_').replace('/', '_') + '.f64')
+
+    def _map(self, key):
+        return np.memmap(self._column_path(key), dtype=np.float64, mode='r+',
+                         shape=(self.capacity,))
+
+    def _new_column(self, key):
+        column = np.memmap(self._column_path(key), dtype=np.float64, mode='w+',
+                           shape=(self.capacity,))
+        column[:] = np.nan
+        self._columns[key] = column
+
+    def _grow(self, rows_needed):
+        capacity = self.capacity
+        while capacity < rows_needed:
+            capacity += self.chunk_rows
+        for key in list(self._columns):
+            # Unmap before resizing the file underneath it
+            self._columns.pop(key).flush()
+            with open(self._column_path(key), 'r+b') as f:
+                f.truncate(capacity * 8)
+            column = np.memmap(self._column_path(key), dtype=np.float64,
+                               mode='r+', shape=(capacity,))
+            column[self.capacity:] = np.nan
+            self._columns[key] = column
+        self.capacity = capacity
+
+    def append(self, columns):
+        '''
+        Append a block of rows, given as a dictionary of equal length
+        float64 arrays
+        '''
+        count = len(columns['raw_timestamp'])
+        if count == 0:
+            return
+        if self.rows + count > self.capacity:
+            self._grow(self.rows + count)
+        for key in columns:
+            if key not in self._columns:
+                self._new_column(key)
+        for key, column in self._columns.items():
+            if key in columns:
+                column[self.rows:self.rows + count] = columns[key]
+        self.rows += count
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = {'rows': self.rows, 'capacity': self.capacity, 'keys': list(self._columns)}
+        with open(self._meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def query(self, start, end, keys=None):
+        '''
+        Returns every row with start <= raw_timestamp <= end, sorted by
+        timestamp, as a dictionary of lists with NaN as None
+        '''
+        if 'raw_timestamp' not in self._columns:
+            return {}
+        timestamps = self._columns['raw_timestamp'][:self.rows]
+        rows = np.nonzero((timestamps >= start) & (timestamps <= end))[0]
+        rows = rows[np.argsort(timestamps[rows], kind='stable')]
+        if keys is None:
+            keys = list(self._columns)
+        elif 'raw_timestamp' not in keys:
+            keys = ['raw_timestamp'] + list(keys)
+        result = {}
+        for key in keys:
+            if key not in self._columns:
+                continue
+            values = self._columns[key][rows]
+            result[key] = [None if v != v else float(v) for v in values]
+        return result
+
+    def flush(self):
+        for column in self._columns.values():
+            column.flush()
+
+
+def decode_packets(body):
+    '''
+    Turn a request body into a list of packet dictionaries, whichever
+    of the accepted shapes it arrived in
+    '''
+    decoded = json.loads(body)
+    if isinstance(decoded, str):
+        decoded = json.loads(decoded)
+    if isinstance(decoded, dict):
+        decoded = [decoded]
+    packets = []
+    for packet in decoded:
+        if isinstance(packet, str):
+            packet = json.loads(packet)
+        if not isinstance(packet, dict) or 'raw_timestamp' not in packet:
+            raise ValueError("Packet has no raw_timestamp column")
+        packets.append(packet)
+    return packets
+
+
+def packets_to_columns(packets):
+    '''
+    Decode a batch of packets into one dictionary of float64 arrays.
+
+    Sensors_Packet only starts a key's list when the key is first seen,
+    so a short list belongs to the end of its packet and is padded with
+    NaN at the front. Keys missing from a packet are NaN for all its rows.
+    '''
+    sizes = [len(packet['raw_timestamp']) for packet in packets]
+    total = sum(sizes)
+    keys = set()
+    for packet in packets:
+        keys.update(packet)
+    columns = {key: np.full(total, np.nan) for key in keys}
+    offset = 0
+    for packet, size in zip(packets, sizes):
+        for key, values in packet.items():
+            if not isinstance(values, list) or size == 0:
+                continue
+            # None becomes NaN in the float conversion
+            values = np.asarray(values, dtype=np.float64)[-size:]
+            end = offset + size
+            columns[key][end - len(values):end] = values
+        offset += size
+    return columns
+
+
+def compact_to_columns(body):
+    '''
+    Decode one or more back to back compact packets straight into
+    float64 columns, reading each packet's columns with one frombuffer
+    '''
+    packets = []
+    offset = 0
+    while offset < len(body):
+        if offset + struct.calcsize('<2sBHB') > len(body):
+            raise ValueError("Compact sensor packet cut short in its header")
+        magic, version, count, key_count = struct.unpack_from('<2sBHB', body, offset)
+        if magic != b'AQ' or version != 1:
+            raise ValueError("Not a compact sensor packet")
+        offset += struct.calcsize('<2sBHB')
+        keys = []
+        for _ in range(key_count):
+            if offset >= len(body) or offset + 1 + body[offset] > len(body):
+                raise ValueError("Compact sensor packet cut short in its keys")
+            length = body[offset]
+            keys.append(body[offset + 1:offset + 1 + length].decode('utf-8'))
+            offset += 1 + length
+        if offset + 4 * count * (1 + key_count) > len(body):
+            raise ValueError("Compact sensor packet cut short in its values")
+        columns = {'raw_timestamp': np.frombuffer(body, '<u4', count, offset).astype(np.float64)}
+        offset += 4 * count
+        values = np.frombuffer(body, '<f4', count * key_count, offset).astype(np.float64)
+        offset += 4 * count * key_count
+        for key, column in zip(keys, values.reshape(key_count, count)):
+            columns[key] = column
+        packets.append(columns)
+
+    if len(packets) == 1:
+        return packets[0]
+    keys = set()
+    for columns in packets:
+        keys.update(columns)
+    return {key: np.concatenate([columns.get(key, np.full(len(columns['raw_timestamp']), np.nan))
+                                 for columns in packets])
+            for key in keys}
+
+
+class Home_Server(object):
+    '''
+    Minimal asyncio HTTP/1.1 server implementing the home server
+    endpoints, with a Column_Store per device.
+
+    Keeps connections alive between requests, the same as
+    adafruit_requests expects.
+    '''
+    def __init__(self, data_directory, sea_level=1013.25):
+        self.data_directory = data_directory
+        self.sea_level = sea_level
+        self.stores = {}
+        self.requests_served = 0
+        self.rows_received = 0
+        # Readings the rows stand for: a rollup row counts its samples
+        self.readings_received = 0
+        self.rollup_rows_received = 0
+        self.rollup_readings_received = 0
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._connections = {}
+
+    def store_for(self, device):
+        '''
+        The Column_Store for device, which must be a valid device id
+        (see valid_device)
+        '''
+        if not self.valid_device(device):
+            raise ValueError("Bad device id %r" % device)
+        if device not in self.stores:
+            directory = os.path.join(self.data_directory, device)
+            self.stores[device] = Column_Store(directory)
+        return self.stores[device]
+
+    def stored_device(self, device):
+        '''
+        The Column_Store for device if it has any data, opening one left
+        on disk by an earlier run, otherwise None
+        '''
+        if device in self.stores:
+            return self.stores[device]
+        if self.valid_device(device) and os.path.exists(
+                os.path.join(self.data_directory, device, 'meta.json')):
+            return self.store_for(device)
+        return None
+
+    @staticmethod
+    def valid_device(device):
+        return bool(_DEVICE_ID.match(device)) and device not in ('.', '..')
+
+    def ingest(self, device, body, compact=False):
+        '''
+        Decode one request or message body of packets and store it for
+        device, returning the row count. Raises ValueError, TypeError,
+        KeyError or struct.error on a body that doesn't decode
+        '''
+        if compact:
+            columns = compact_to_columns(body)
+        else:
+            columns = packets_to_columns(decode_packets(body))
+        self.store_for(device).append(columns)
+        rows = len(columns['raw_timestamp'])
+        self.rows_received += rows
+        self.readings_received += rows
+        if 'samples' in columns:
+            rollups = ~np.isnan(columns['samples'])
+            rollup_readings = int(columns['samples'][rollups].sum())
+            self.rollup_rows_received += int(rollups.sum())
+            self.rollup_readings_received += rollup_readings
+            self.readings_received += rollup_readings - int(rollups.sum())
+        return rows
+
+    async def start(self, host='127.0.0.1', port=5000):
+        self._server = await asyncio.start_server(self._handle_connection, host, port,
+                                                  backlog=1024)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self, host='127.0.0.1', port=5000):
+        port = await self.start(host, port)
+        print("Home server stand-in listening on", host, port)
+        async with self._server:
+            await self._server.serve_forever()
+
+    def serve_in_background(self, host='127.0.0.1', port=0):
+        '''
+        Start the server on its own event loop in a daemon thread and
+        return the port it is listening on
+        '''
+        started = threading.Event()
+        result = {}
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            result['port'] = self._loop.run_until_complete(self.start(host, port))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return result['port']
+
+    async def _shutdown(self):
+        self._server.close()
+        # Hang up on clients still holding connections open, and let
+        # their handlers see the connection end
+        connections = list(self._connections.items())
+        for task, writer in connections:
+            writer.close()
+        await asyncio.gather(*[task for task, writer in connections], return_exceptions=True)
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+        for store in self.stores.values():
+            store.flush()
+
+    async def _handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        peer = peer[0] if peer else 'unknown'
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+
+                status, payload = self._route(method, target, headers, body, peer)
+                self.requests_served += 1
+                keep_alive = (headers.get('connection', '').lower() != 'close'
+                              and version == 'HTTP/1.1')
+                data = json.dumps(payload).encode()
+                writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json\r\n'
+                              'Content-Length: %d\r\nConnection: %s\r\n\r\n'
+                              % (status, len(data), 'keep-alive' if keep_alive else 'close')
+                              ).encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    def _route(self, method, target, headers, body, peer):
+        url = urlsplit(target)
+        # Addresses are only a fallback, IPv6 ones would need their colons swapped
+        device = headers.get('x-device-id', peer.replace(':', '_'))
+        if not self.valid_device(device):
+            return '400 Bad Request', {'error': 'device ids may only use letters, digits, _ . and -'}
+        if url.path == '/enviornmental_sensors' and method == 'POST':
+            compact = headers.get('content-type', '').startswith('application/octet-stream')
+            try:
+                rows = self.ingest(device, body, compact)
+            except (ValueError, TypeError, KeyError, struct.error) as e:
+                return '400 Bad Request', {'error': str(e)}
+            return '200 OK', {'rows': rows}
+        if url.path == '/api/weather_status' and method == 'GET':
+            return '200 OK', {'sea level': self.sea_level}
+        if url.path == '/api/sensors' and method == 'GET':
+            query = parse_qs(url.query)
+            device = query.get('device', [device])[0]
+            if not self.valid_device(device):
+                return '400 Bad Request', {'error': 'device ids may only use letters, digits, _ . and -'}
+            store = self.stored_device(device)
+            if store is None:
+                return '404 Not Found', {'error': 'no data for device ' + device}
+            try:
+                start = float(query.get('start', ['-inf'])[0])
+                end = float(query.get('end', ['inf'])[0])
+            except ValueError:
+                return '400 Bad Request', {'error': 'start and end must be numbers'}
+            keys = query['keys'][0].split(',') if 'keys' in query else None
+            return '200 OK', store.query(start, end, keys)
+        return '404 Not Found', {'error': 'no route for ' + method + ' ' + url.path}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Home server stand-in for the air quality monitors")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--data', default='server_data', help="Directory for the column files")
+    parser.add_argument('--sea-level', type=float, default=1013.25,
+                        help="Pressure at sea level (mBar) served to the bme280")
+    args = parser.parse_args()
+
+    server = Home_Server(args.data, sea_level=args.sea_level)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+'''
+Stand-in MQTT broker for the monitors' MQTT uploader
+
+Runs under CPython (not on the board) and speaks enough of MQTT 3.1.1
+for lib/uploaders.py's MQTT_Uploader and for a subscriber watching the
+packets go by: CONNECT, PUBLISH at QoS 0 and 1, SUBSCRIBE and
+UNSUBSCRIBE (with + and # wildcards), PINGREQ and DISCONNECT. QoS 2,
+retained messages, wills and persistent sessions are not supported. A
+client that goes quiet for one and a half keep alive periods is hung up
+on, as a real broker would.
+
+Given a Home_Server (tools/home_server.py), packets published to
+    <topic prefix>/<device id>/packets
+are decoded and stored in that server's column store for the device,
+json or compact, before the PUBACK goes back. So a monitor publishing
+here ends up with the same history as one posting over HTTP, and it can
+be queried the same way.
+
+    python tools/mqtt_broker.py --port 1883 --data server_data
+
+Tests and the fleet simulator start it in a background thread with
+MQTT_Broker.serve_in_background(), and talk to it with
+Simple_MQTT_Client, which covers the part of adafruit_minimqtt's client
+that MQTT_Uploader uses.
+
+Storing packets requires numpy, for the home server stand-in.
+'''
+import argparse
+import asyncio
+import os
+import socket
+import struct
+import sys
+import threading
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'lib'))
+
+from uploaders import MMQTTException
+
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(text):
+    data = text.encode('utf-8')
+    return struct.pack('>H', len(data)) + data
+
+
+def decode_string(body, offset):
+    length, = struct.unpack_from('>H', body, offset)
+    offset += 2
+    return body[offset:offset + length].decode('utf-8'), offset + length
+
+
+def make_packet(packet_type, body=b'', flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class MQTT_Broker(object):
+    '''
+    Minimal asyncio MQTT broker. With a home_server, packets published
+    under topic_prefix are stored per device; messages on every topic
+    are passed on to matching subscribers at QoS 0.
+    '''
+    def __init__(self, home_server=None, topic_prefix='air_monitor'):
+        self.home_server = home_server
+        self.topic_prefix = topic_prefix
+        self.connections_accepted = 0
+        self.messages_received = 0
+        self.bad_payloads = 0
+        self._subscriptions = {}
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._connections = {}
+
+    async def start(self, host='127.0.0.1', port=1883):
+        self._server = await asyncio.start_server(self._handle_connection, host, port,
+                                                  backlog=1024)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self, host='127.0.0.1', port=1883):
+        port = await self.start(host, port)
+        print("MQTT broker stand-in listening on", host, port)
+        async with self._server:
+            await self._server.serve_forever()
+
+    def serve_in_background(self, host='127.0.0.1', port=0):
+        '''
+        Start the broker on its own event loop in a daemon thread and
+        return the port it is listening on
+        '''
+        started = threading.Event()
+        result = {}
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            result['port'] = self._loop.run_until_complete(self.start(host, port))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return result['port']
+
+    async def _shutdown(self):
+        self._server.close()
+        connections = list(self._connections.items())
+        for task, writer in connections:
+            writer.close()
+        await asyncio.gather(*[task for task, writer in connections], return_exceptions=True)
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+
+    async def _read_packet(self, reader, timeout):
+        first = await asyncio.wait_for(reader.readexactly(1), timeout)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+            if multiplier > 128 ** 3:
+                raise ValueError("Malformed remaining length")
+        body = await reader.readexactly(length) if length else b''
+        return first[0] >> 4, first[0] & 0x0f, body
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            # The first packet has to be a CONNECT
+            packet_type, flags, body = await self._read_packet(reader, 10)
+            if packet_type != CONNECT:
+                return
+            protocol, offset = decode_string(body, 0)
+            level, connect_flags, keep_alive = struct.unpack_from('>BBH', body, offset)
+            if protocol != 'MQTT' or level != 4:
+                # Unacceptable protocol version
+                writer.write(make_packet(CONNACK, b'\x00\x01'))
+                return
+            writer.write(make_packet(CONNACK, b'\x00\x00'))
+            await writer.drain()
+            self.connections_accepted += 1
+            timeout = keep_alive * 1.5 if keep_alive else None
+
+            while True:
+                packet_type, flags, body = await self._read_packet(reader, timeout)
+                if packet_type == PUBLISH:
+                    self._publish(writer, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    packet_id, = struct.unpack_from('>H', body, 0)
+                    offset = 2
+                    granted = bytearray()
+                    while offset < len(body):
+                        topic_filter, offset = decode_string(body, offset)
+                        offset += 1
+                        self._subscriptions.setdefault(writer, []).append(topic_filter)
+                        # Everything goes out to subscribers at QoS 0
+                        granted.append(0)
+                    writer.write(make_packet(SUBACK, struct.pack('>H', packet_id) + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id, = struct.unpack_from('>H', body, 0)
+                    offset = 2
+                    filters = self._subscriptions.get(writer, [])
+                    while offset < len(body):
+                        topic_filter, offset = decode_string(body, offset)
+                        if topic_filter in filters:
+                            filters.remove(topic_filter)
+                    writer.write(make_packet(UNSUBACK, struct.pack('>H', packet_id)))
+                elif packet_type == PINGREQ:
+                    writer.write(make_packet(PINGRESP))
+                elif packet_type == DISCONNECT:
+                    break
+                else:
+                    # Nothing else is expected from a client here
+                    break
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ValueError, struct.error, UnicodeDecodeError):
+            pass
+        finally:
+            del self._connections[task]
+            self._subscriptions.pop(writer, None)
+            writer.close()
+
+    def _publish(self, writer, flags, body):
+        qos = (flags >> 1) & 0x03
+        if qos > 1:
+            raise ValueError("QoS 2 is not supported")
+        topic, offset = decode_string(body, 0)
+        packet_id = None
+        if qos:
+            packet_id, = struct.unpack_from('>H', body, offset)
+            offset += 2
+        payload = body[offset:]
+        self.messages_received += 1
+
+        levels = topic.split('/')
+        if (self.home_server is not None and len(levels) == 3
+                and levels[0] == self.topic_prefix and levels[2] == 'packets'):
+            try:
+                # Compact packets start with their magic, json with a bracket or quote
+                self.home_server.ingest(levels[1], payload, payload[:2] == b'AQ')
+            except (ValueError, TypeError, KeyError, struct.error):
+                # Acknowledged anyway, a resend would fail the same way
+                self.bad_payloads += 1
+
+        forward = make_packet(PUBLISH, encode_string(topic) + payload)
+        for subscriber, filters in list(self._subscriptions.items()):
+            if any(topic_matches(topic_filter, topic) for topic_filter in filters):
+                subscriber.write(forward)
+        if qos:
+            writer.write(make_packet(PUBACK, struct.pack('>H', packet_id)))
+
+
+class Simple_MQTT_Client(object):
+    '''
+    Blocking MQTT 3.1.1 client with the parts of adafruit_minimqtt.MQTT
+    that MQTT_Uploader uses: connect, publish (waiting for the PUBACK at
+    QoS 1), ping and disconnect. Socket errors come out as OSError and
+    protocol errors as MMQTTException, as they do on the board.
+    '''
+    def __init__(self, broker, port=1883, client_id='', keep_alive=60, recv_timeout=10):
+        self.broker = broker
+        self.port = port
+        self.client_id = client_id
+        self.keep_alive = keep_alive
+        self.recv_timeout = recv_timeout
+        self._socket = None
+        self._buffer = b''
+        self._packet_id = 0
+
+    def is_connected(self):
+        return self._socket is not None
+
+    def _receive(self, size):
+        while len(self._buffer) < size:
+            try:
+                data = self._socket.recv(4096)
+            except socket.timeout:
+                raise MMQTTException("Broker didn't reply in time")
+            if not data:
+                self._close()
+                raise MMQTTException("Broker closed the connection")
+            self._buffer += data
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def _read_packet(self):
+        first = self._receive(1)[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self._receive(1)[0]
+            length += (byte & 0x7f) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return first >> 4, self._receive(length)
+
+    def _wait_for(self, wanted_type, packet_id=None):
+        while True:
+            packet_type, body = self._read_packet()
+            if packet_type != wanted_type:
+                # A message for a subscription, not what we're after
+                continue
+            if packet_id is None or struct.unpack_from('>H', body, 0)[0] == packet_id:
+                return body
+
+    def _close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            self._buffer = b''
+
+    def connect(self):
+        self._socket = socket.create_connection((self.broker, self.port), timeout=self.recv_timeout)
+        # Clean session, no will or credentials
+        body = (encode_string('MQTT') + struct.pack('>BBH', 4, 0x02, self.keep_alive)
+                + encode_string(self.client_id))
+        self._socket.sendall(make_packet(CONNECT, body))
+        reply = self._wait_for(CONNACK)
+        if reply[1] != 0:
+            self._close()
+            raise MMQTTException("Connection refused, return code %d" % reply[1])
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if self._socket is None:
+            raise MMQTTException("Not connected")
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        body = encode_string(topic)
+        packet_id = None
+        if qos:
+            self._packet_id = self._packet_id % 65535 + 1
+            packet_id = self._packet_id
+            body += struct.pack('>H', packet_id)
+        self._socket.sendall(make_packet(PUBLISH, body + msg, qos << 1 | int(retain)))
+        if qos:
+            self._wait_for(PUBACK, packet_id)
+
+    def ping(self):
+        self._socket.sendall(make_packet(PINGREQ))
+        self._wait_for(PINGRESP)
+
+    def disconnect(self):
+        if self._socket is not None:
+            try:
+                self._socket.sendall(make_packet(DISCONNECT))
+            finally:
+                self._close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MQTT broker stand-in for the air quality monitors")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--data', default=None,
+                        help="Store published packets in this directory, as the home server would")
+    parser.add_argument('--topic-prefix', default='air_monitor')
+    args = parser.parse_args()
+
+    home_server = None
+    if args.data is not None:
+        from home_server import Home_Server
+        home_server = Home_Server(args.data)
+    broker = MQTT_Broker(home_server, topic_prefix=args.topic_prefix)
+    try:
+        asyncio.run(broker.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+        if home_server is not None:
+            home_server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+'''
+Turn tick profiler dumps into collapsed stacks for flame graphs
+
+Reads the PROFILE blocks that lib/tick_profiler.py writes, from a saved
+serial console log or a dump file on the board (anything between blocks
+is ignored), adds up every block, and prints one line per stack:
+
+    tick;update_sensors;update bme280 48213
+
+where the number is the time spent in that span itself, not in the spans
+under it, in microseconds. That is the collapsed stack format
+flamegraph.pl and speedscope read:
+
+    python tools/profile_to_flamegraph.py serial.log > ticks.folded
+    flamegraph.pl ticks.folded > ticks.svg
+
+--slowest N lists the N longest single spans from the dumps' rings instead.
+'''
+import argparse
+import sys
+
+
+def read_blocks(lines):
+    '''
+    Yields (nodes, spans) for every complete PROFILE block, nodes as
+    {index: (parent, count, total ns, child ns, name)} and spans as a
+    list of (node index, duration ns)
+    '''
+    nodes = None
+    spans = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith("PROFILE begin"):
+            nodes = {}
+            spans = []
+        elif nodes is None:
+            continue
+        elif line == "PROFILE end":
+            yield nodes, spans
+            nodes = None
+        elif line.startswith("node "):
+            fields = line.split(" ", 6)
+            index, parent, count, total, child = [int(field) for field in fields[1:6]]
+            nodes[index] = (parent, count, total, child, fields[6])
+        elif line.startswith("span "):
+            fields = line.split()
+            spans.append((int(fields[1]), int(fields[2])))
+
+
+def stack_path(nodes, index):
+    names = []
+    while index >= 0:
+        parent, count, total, child, name = nodes[index]
+        names.append(name)
+        index = parent
+    return ";".join(reversed(names))
+
+
+def collapse(blocks):
+    '''
+    Self time in microseconds for every stack, summed over the blocks
+    '''
+    stacks = {}
+    for nodes, spans in blocks:
+        for index in nodes:
+            parent, count, total, child, name = nodes[index]
+            if not count:
+                continue
+            path = stack_path(nodes, index)
+            stacks[path] = stacks.get(path, 0) + max(0, total - child)
+    return {path: ns // 1000 for path, ns in stacks.items()}
+
+
+def slowest(blocks, count):
+    spans = []
+    for nodes, ring in blocks:
+        for index, duration in ring:
+            spans.append((duration, stack_path(nodes, index)))
+    spans.sort(reverse=True)
+    return spans[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert tick profiler dumps to collapsed stacks")
+    parser.add_argument('dumps', nargs='*', help="Serial logs or dump files, stdin if none")
+    parser.add_argument('--slowest', type=int, metavar='N',
+                        help="List the N longest recent spans instead")
+    args = parser.parse_args()
+
+    blocks = []
+    if args.dumps:
+        for path in args.dumps:
+            with open(path, errors='replace') as f:
+                blocks.extend(read_blocks(f))
+    else:
+        blocks.extend(read_blocks(sys.stdin))
+    if not blocks:
+        sys.exit("No PROFILE blocks found")
+
+    if args.slowest:
+        for duration, path in slowest(blocks, args.slowest):
+            print("%10.3f ms  %s" % (duration / 1e6, path))
+        return
+
+    for path, micros in sorted(collapse(blocks).items()):
+        if micros:
+            print("%s %d" % (path, micros))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+Check a monitor config file before it goes on a board
+
+Runs the same validation code.py does at boot (lib/monitor_config.py),
+and reports every problem at once rather than the board stopping on the
+first. With --show, prints the config the board would actually run,
+defaults filled in.
+
+    python tools/validate_config.py config.json
+    python tools/validate_config.py --show boards/*.json
+'''
+import argparse
+import json
+import os
+import sys
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'lib'))
+
+from monitor_config import DEFAULT_CONFIG, merge_config, validate_config
+
+
+def check_file(path, show=False):
+    '''
+    Validate one file, printing what's wrong with it. Returns whether
+    it is good to run
+    '''
+    try:
+        with open(path) as f:
+            overrides = json.load(f)
+    except OSError as e:
+        print("%s: can't read: %s" % (path, e))
+        return False
+    except ValueError as e:
+        print("%s: not valid json: %s" % (path, e))
+        return False
+    if not isinstance(overrides, dict):
+        print("%s: config must be a json object" % path)
+        return False
+
+    config = merge_config(DEFAULT_CONFIG, overrides)
+    errors = validate_config(config)
+    if errors:
+        for error in errors:
+            print("%s: %s" % (path, error))
+        return False
+
+    enabled = [name for name in config['sensors'] if config['sensors'][name]['enabled']]
+    uploader = config['uploader']
+    if uploader['backend'] == 'mqtt':
+        destination = "mqtt://%s:%d" % (uploader['mqtt']['broker'], uploader['mqtt']['port'])
+    elif uploader['backend'] == 'file':
+        destination = uploader['file']['path'] or "usb serial"
+    else:
+        destination = config['server']['base_url']
+    print("%s: OK (%s, %s packets of %d, sensors: %s)"
+          % (path, destination, config['wire_format'],
+             config['packet_size_limit'], ", ".join(enabled)))
+    if show:
+        print(json.dumps(config, indent=2))
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate air quality monitor config files")
+    parser.add_argument('paths', nargs='+', metavar='config.json')
+    parser.add_argument('--show', action='store_true',
+                        help="Print the config with defaults filled in")
+    args = parser.parse_args()
+
+    results = [check_file(path, args.show) for path in args.paths]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()